@@ -6,6 +6,7 @@ class CellsEvaluator(PerformanceEvaluator):
     def __init__(self, truth, cellsProcessor):
         self.truth = truth
         self.cells = cellsProcessor.cells
+        self.cells_angles = cellsProcessor.cells_angles
         
 
     def count_true(self):
@@ -35,21 +36,28 @@ class CellsEvaluator(PerformanceEvaluator):
         """
         Calculates the total number of true pairs that were reconstructed
         """
-        count = 0
+        # Particle of each hit of each cell, dimensionality (cell, hit)
+        cell_particle_ids = self.truth.particles_of(self.cells)
 
-        hit_ids = self.truth.hit_ids
-        particle_ids =  self.truth.particle_ids
+        # (hits unknown to the truth, of particle id -1, are never matched)
+        is_true = (cell_particle_ids[:, 0] == cell_particle_ids[:, 1]) & (
+            cell_particle_ids[:, 0] >= 0
+        )
 
-        for cell in self.cells:
-            hit1_index = np.where(hit_ids == cell[0])[0][0]
-            hit2_index = np.where(hit_ids == cell[1])[0][0]
+        # Kept for the threshold curves
+        self.are_true_cells = is_true
 
-            hit1_particle_id = particle_ids[hit1_index]
-            hit2_particle_id = particle_ids[hit2_index]
+        self.true_rec_count = int(np.count_nonzero(is_true))
 
-            if hit1_particle_id == hit2_particle_id:
-                count += 1
-    
-        self.true_rec_count = count
-        
-        
+    def performance_curve(self, cell_angles):
+        """
+        Efficiency and purity of the cells for each cell angle (min_angle of CellsProcessor)
+        in cell_angles, from cells formed once with the widest of them (see threshold_curve)
+        """
+        if not hasattr(self, "are_true_cells"):
+            self.count_true_rec()
+
+        # A cell is formed if its cone angle is strictly below min_angle (see is_in_cone)
+        return self.threshold_curve(
+            self.cells_angles, self.are_true_cells, cell_angles, inclusive=False
+        )
@@ -1,4 +1,6 @@
 import numpy as np
+import pandas as pd
+
 from .performance_evaluator import PerformanceEvaluator
 
 
@@ -7,6 +9,9 @@ class NeighboursEvaluator(PerformanceEvaluator):
         self.truth = truth
         self.CA = neighboursProcessor.CA
         self.cells = neighboursProcessor.cells
+        self.cells_angles = neighboursProcessor.cells_angles
+        self.neighbours_angles = neighboursProcessor.neighbours_angles
+        self.hits = neighboursProcessor.hits
 
     def count_true(self):
         """
@@ -33,45 +38,133 @@ class NeighboursEvaluator(PerformanceEvaluator):
         """
         Returns the total number of neighbours that were reconstructed.
 
-        This is equal to the total # of inner neighbours
+        This is equal to the total # of inner neighbours, i.e. of edges of the CA
         """
-        count = 0
-
-        for cell in self.CA.keys():
-            count += len(self.CA[cell]["inner_neighs"])
+        outer, inner = self.CA.edges()
 
-        self.rec_count = count
+        self.rec_count = outer.shape[0]
 
     def count_true_rec(self):
         """
         Returns the total number of true pairs that were reconstructed
         """
-        count = 0
-
-        # Generates a dict containing all hits and of shape {hit_id: particle_id}
-        map_hit_to_particle = {
-            item[0]: item[1]
-            for item in self.truth[["hit_id", "particle_id"]].to_numpy()
-        }
-
-        # Loops through all cells
-        for cell_index, cell_info in self.CA.items():
-            hit_id3 = self.cells[cell_index][1]
-            hit_id2 = self.cells[cell_index][0]
-            particle_id3 = map_hit_to_particle[hit_id3]
-            particle_id2 = map_hit_to_particle[hit_id2]
-
-            # Checks whether the particle_id of the two hits of the cell match
-            if particle_id3 == particle_id2:
-                # Loops through the inner neighbours
-                for neigh_index in cell_info["inner_neighs"]:
-                    hit_id1 = self.cells[neigh_index][0]  # inner hit of inner neigh
-                    particle_id1 = map_hit_to_particle[hit_id1]
-
-                    # Check whether the inner hit of the inner neighbour also has the same particle id,
-                    # in which case all 3 hits of the neighbour bound are from the same true particle
-                    if particle_id1 == particle_id2:
-                        count += 1
-
-        self.true_rec_count = count
+        # Edge list of the CA: inner cell inner[i] is an inner neighbour of outer cell outer[i]
+        outer, inner = self.CA.edges()
+
+        # Outer and inner hits of the outer cell, and inner hit of the inner cell
+        particle_ids3 = self.truth.particles_of(self.cells[outer, 1])
+        particle_ids2 = self.truth.particles_of(self.cells[outer, 0])
+        particle_ids1 = self.truth.particles_of(self.cells[inner, 0])
+
+        # Whether all 3 hits of each neighbour bound are from the same true particle
+        # (hits unknown to the truth, of particle id -1, are never matched)
+        is_true = (
+            (particle_ids3 == particle_ids2)
+            & (particle_ids1 == particle_ids2)
+            & (particle_ids2 >= 0)
+        )
+
+        # Kept for the breakdown per layer triad
+        self.edges = (outer, inner)
+        self.are_true_edges = is_true
+
+        self.true_rec_count = int(np.count_nonzero(is_true))
+
+    def performance_curve(self, neigh_angles, cell_angle=None):
+        """
+        Efficiency and purity of the neighbours for each neighbour angle (max_angle of
+        NeighboursProcessor) in neigh_angles, from neighbours found once with the widest of them
+        (see threshold_curve)
+
+        - cell_angle: None | float, if float, the neighbours are those of the cells that
+        would have been formed with that (smaller) cell angle
+        """
+        if not hasattr(self, "are_true_edges"):
+            self.count_true_rec()
+
+        angles, are_true = self.neighbours_angles, self.are_true_edges
+
+        if cell_angle is not None:
+            outer, inner = self.edges
+            are_formed = (self.cells_angles[outer] < cell_angle) & (
+                self.cells_angles[inner] < cell_angle
+            )
+            angles, are_true = angles[are_formed], are_true[are_formed]
 
+        return self.threshold_curve(angles, are_true, neigh_angles, inclusive=True)
+
+    def performance_per_triad(self):
+        """
+        Breakdown of the counts, efficiency and purity per triad of layers, that is,
+        per (layer of hit 1, layer of hit 2, layer of hit 3) of the neighbour bounds
+        (with hit 1 the innermost hit). Reuses the edges labelled by count_true_rec.
+
+        True neighbours are the triplets of consecutive hits (ordered by layer) of a particle.
+
+        returns a DataFrame indexed by triad, with columns
+        true_count, rec_count, true_rec_count, efficiency, purity
+        """
+        if not hasattr(self, "are_true_edges"):
+            self.count_true_rec()
+
+        outer, inner = self.edges
+
+        # Layer of any hit, from the hits sorted by hit_id
+        hit_ids = self.hits.hit_ids
+        hit_order = np.argsort(hit_ids)
+        hit_layers = self.hits["layer_id"].to_numpy()[hit_order]
+
+        def layers_of(hits):
+            return hit_layers[np.searchsorted(hit_ids[hit_order], hits)]
+
+        rec_triads = np.stack(
+            (
+                layers_of(self.cells[inner, 0]),
+                layers_of(self.cells[outer, 0]),
+                layers_of(self.cells[outer, 1]),
+            ),
+            axis=1,
+        )
+
+        # Triplets of consecutive hits (by layer) of each particle
+        particle_ids = self.truth.particle_ids
+        truth_layers = layers_of(self.truth.hit_ids)
+
+        order = np.lexsort((truth_layers, particle_ids))
+        particle_ids, truth_layers = particle_ids[order], truth_layers[order]
+        starts = np.flatnonzero(particle_ids[:-2] == particle_ids[2:])
+        true_triads = np.stack(
+            (truth_layers[starts], truth_layers[starts + 1], truth_layers[starts + 2]),
+            axis=1,
+        )
+
+        # Counting per triad
+        all_triads, triad_indices = np.unique(
+            np.concatenate((true_triads, rec_triads)).reshape(-1, 3),
+            axis=0,
+            return_inverse=True,
+        )
+        triad_indices = triad_indices.reshape(-1)
+        true_indices = triad_indices[: true_triads.shape[0]]
+        rec_indices = triad_indices[true_triads.shape[0] :]
+
+        n_triads = all_triads.shape[0]
+        performance = pd.DataFrame(
+            {
+                "true_count": np.bincount(true_indices, minlength=n_triads),
+                "rec_count": np.bincount(rec_indices, minlength=n_triads),
+                "true_rec_count": np.bincount(
+                    rec_indices[self.are_true_edges], minlength=n_triads
+                ),
+            },
+            index=pd.MultiIndex.from_arrays(
+                all_triads.T, names=["layer1", "layer2", "layer3"]
+            ),
+        )
+
+        performance["efficiency"] = (
+            performance["true_rec_count"] / performance["true_count"]
+        )
+        performance["purity"] = performance["true_rec_count"] / performance["rec_count"]
+
+        return performance
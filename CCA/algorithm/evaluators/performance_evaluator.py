@@ -1,5 +1,8 @@
 from abc import abstractmethod
 
+import numpy as np
+import pandas as pd
+
 
 class PerformanceEvaluator:
     def evaluate(self):
@@ -39,6 +42,41 @@ class PerformanceEvaluator:
         self.efficiency = self.true_rec_count / self.true_count
         self.purity = self.true_rec_count / self.rec_count
 
+    def threshold_curve(self, angles, are_true, thresholds, inclusive=True):
+        """
+        Efficiency and purity against an angle threshold, in one pass: the reconstructed
+        objects (cells or neighbours) at a threshold are those whose angle is below it, so
+        sorting the angles once, the counts at every threshold are read from a cumulative sum.
+
+        - angles: angle of each reconstructed object (at the widest threshold)
+        - are_true: whether each reconstructed object is true
+        - thresholds: the angle thresholds, none of them above the one used for reconstruction
+        - inclusive: whether objects whose angle equals the threshold are reconstructed
+
+        returns a DataFrame indexed by threshold, with columns
+        rec_count, true_rec_count, efficiency, purity
+        """
+        if not hasattr(self, "true_count"):
+            self.count_true()
+
+        order = np.argsort(angles, kind="stable")
+        cumulated_true = np.concatenate(([0], np.cumsum(are_true[order])))
+
+        thresholds = np.asarray(thresholds, dtype=float)
+        rec_counts = np.searchsorted(
+            angles[order], thresholds, side="right" if inclusive else "left"
+        )
+        true_rec_counts = cumulated_true[rec_counts]
+
+        curve = pd.DataFrame(
+            {"rec_count": rec_counts, "true_rec_count": true_rec_counts},
+            index=pd.Index(thresholds, name="threshold"),
+        )
+        curve["efficiency"] = curve["true_rec_count"] / self.true_count
+        curve["purity"] = curve["true_rec_count"] / curve["rec_count"]
+
+        return curve
+
     @abstractmethod
     def count_true(self):
         pass
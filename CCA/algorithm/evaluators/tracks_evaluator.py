@@ -1,4 +1,6 @@
 import numpy as np
+
+from CCA.data.custom_tools import row_keys
 from .performance_evaluator import PerformanceEvaluator
 
 
@@ -33,34 +35,68 @@ class TracksEvaluator(PerformanceEvaluator):
         self.rec_count = self.tracks.size
 
     def count_true_rec(self):
-        """    
+        """
         Returns the number of true tracks that are exactly reconstructed by a candidat track
 
+        (see match_tracks)
+        """
+        is_matched, _, _ = self.match_tracks()
+
+        self.true_rec_count = int(
+            sum(np.count_nonzero(matched) for matched in is_matched.values())
+        )
+
+    def match_tracks(self):
+        """
+        Matches the candidate tracks to the true tracks having exactly the same hits.
+
         candidate_dict and true_dict both have shape:
             {
                 track_length: Array of tracks
             }
 
-        where each track is itself an array of its hit_ids, *ordered*.
+        where each track is itself an array of its hit_ids, *ordered*. Each track is turned
+        into a single key (the bytes of its row), and the keys of the true and candidate tracks
+        of a length are grouped with one sort, instead of comparing every pair of tracks.
+
+        returns (is_matched, is_fake, is_duplicate), dictionaries of shape
+            {
+                track_length: boolean array
+            }
+        - is_matched: for each true track of true_dict, whether a candidate reconstructs it
+        - is_fake: for each candidate of candidate_dict, whether it isn't a true track
+        - is_duplicate: for each candidate, whether it reconstructs a true track already
+        reconstructed by a previous candidate
         """
         candidate_dict = self.tracks.to_hits()
         true_dict = self.truth.to_track_dict()
 
-        count = 0
+        is_matched, is_fake, is_duplicate = {}, {}, {}
+
+        for track_length in sorted(set(true_dict).union(candidate_dict)):
+            true_tracks = true_dict.get(track_length, np.empty((0, track_length)))
+            candidate_tracks = candidate_dict.get(
+                track_length, np.empty((0, track_length))
+            )
+            n_true = true_tracks.shape[0]
 
-        for track_length, true_tracks in true_dict.items():
-            if not track_length in candidate_dict:
-                continue
+            keys = row_keys(np.concatenate((true_tracks, candidate_tracks)))
+            _, groups = np.unique(keys, return_inverse=True)
+            groups = groups.reshape(-1)
+            true_groups, candidate_groups = groups[:n_true], groups[n_true:]
 
-            candidate_tracks = candidate_dict[track_length]
+            # Number of true tracks and first candidate of each group of identical tracks
+            true_counts = np.bincount(true_groups, minlength=keys.shape[0])
+            has_candidate = np.zeros(keys.shape[0], dtype=bool)
+            has_candidate[candidate_groups] = True
 
-            for true_track in true_tracks:
-                is_reconstructed = np.any(
-                    np.all(true_track == candidate_tracks, axis=1)
-                )
+            _, first_candidates = np.unique(candidate_groups, return_index=True)
+            is_first = np.zeros(candidate_groups.shape[0], dtype=bool)
+            is_first[first_candidates] = True
 
-                if is_reconstructed:
-                    count += 1
+            is_matched[track_length] = has_candidate[true_groups]
+            is_fake[track_length] = true_counts[candidate_groups] == 0
+            is_duplicate[track_length] = ~is_fake[track_length] & ~is_first
 
-        self.true_rec_count = count
+        return is_matched, is_fake, is_duplicate
 
@@ -1,3 +1,12 @@
+import contextlib
+import io
+import time
+import tracemalloc
+
+import numpy as np
+
+from CCA.data.cellular_automaton import CellularAutomaton
+from CCA.data.stage_cache import StageCache
 from .cells_processor import CellsProcessor
 from .neighbours_processor import NeighboursProcessor
 from .evolution_processor import EvolutionProcessor
@@ -9,46 +18,362 @@ class CCAProcessor:
     Processor for the Classical CA algorithm for particle track reconstruction
     """
 
-    def __init__(self, hits):
+    def __init__(
+        self,
+        hits,
+        max_temp_bytes=None,
+        n_workers=1,
+        stage_cache=None,
+        quiet=False,
+        metrics_callback=None,
+        trace_memory=False,
+    ):
+        """
+        max_temp_bytes: None | int, memory budget (bytes) of the temporaries of the
+        vectorized kernels of cell formation and neighbour finding, which then
+        work in blocks that fit the budget. The budget is best-effort: the temporaries
+        are estimated (not measured), and the ones that can't be split in blocks can
+        exceed it (see peak_temp_bytes)
+        n_workers: number of processes over which the connected components of the CA
+        are spread for evolution and track generation
+        stage_cache: None | StageCache, where the results of cell formation, neighbour finding
+        and evolution are memoized, keyed by a fingerprint of the hits and of the parameters
+        of the stage and of the previous ones. Sharing a StageCache between processors (e.g. when
+        rerunning with another min_track_length), the stages whose inputs didn't change are
+        read from it instead of being run again.
+        quiet: if True, nothing is printed by the stages, whatever their printArgs
+        metrics_callback: None | function called with the metrics record of each stage
+        (see instrument) as soon as the stage is done
+        trace_memory: if True, the peak memory allocated during each stage is traced
+        (with tracemalloc, which slows allocations down: about 15% on runAll)
+        """
         self.hits = hits
+        self.max_temp_bytes = max_temp_bytes
+        self.n_workers = n_workers
+        self.stage_cache = stage_cache
         self.CA = {}
 
+        self.quiet = quiet
+        self.metrics_callback = metrics_callback
+        self.trace_memory = trace_memory
+
+        # Cache keys of the stages run so far
+        self.stage_keys = {}
+
+        # Metrics record of the last run of each stage (see instrument)
+        self.metrics = {}
+
     def runAll(
         self, cell_angle, neigh_angle, min_track_length, printArgs=(True, False)
     ):
+        """
+        Runs all the stages.
+
+        returns the list of the metrics records of the stages (see instrument)
+        """
         self.formCells(cell_angle, printArgs)
         self.findNeighbours(neigh_angle, printArgs)
         self.evolve(printArgs)
         self.generateTracks(min_track_length, printArgs)
 
+        return [
+            self.metrics[stage]
+            for stage in ["cells", "neighbours", "evolution", "tracks"]
+            if stage in self.metrics
+        ]
+
+    @contextlib.contextmanager
+    def instrument(self, stage):
+        """
+        Measures a stage, yielding its metrics record, a dict of shape
+        {
+            "stage": stage name,
+            "wall_time": elapsed time (s),
+            "cpu_time": CPU time of this process (s), not counting worker processes,
+            "peak_memory": peak memory (bytes) allocated during the stage, above what was
+                allocated at its start, as traced by tracemalloc (None if not trace_memory,
+                or if tracemalloc was already tracing and the stage didn't exceed its peak,
+                which is left untouched for the outer measurement),
+            "cached": whether the result was read from the stage cache,
+            "counters": dict of the stage's counters, filled by the stage (the same whether
+                the result was cached or not, the counters being cached with it)
+        }
+        which is then stored in self.metrics[stage] and passed to metrics_callback.
+        The output of the stage is discarded if quiet.
+        """
+        record = {
+            "stage": stage,
+            "wall_time": 0.0,
+            "cpu_time": 0.0,
+            "peak_memory": None,
+            "cached": False,
+            "counters": {},
+        }
+
+        # Tracing only for the stage, unless it was already being traced
+        # (the peak of an outer measurement is then kept, rather than reset)
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            start_memory, start_peak = tracemalloc.get_traced_memory()
+
+        output = (
+            contextlib.redirect_stdout(io.StringIO())
+            if self.quiet
+            else contextlib.nullcontext()
+        )
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+
+        try:
+            with output:
+                yield record
+
+        finally:
+            record["wall_time"] = time.perf_counter() - wall_start
+            record["cpu_time"] = time.process_time() - cpu_start
+
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                if started_tracing or peak > start_peak:
+                    record["peak_memory"] = peak - start_memory
+            if started_tracing:
+                tracemalloc.stop()
+
+        self.metrics[stage] = record
+        if self.metrics_callback is not None:
+            self.metrics_callback(record)
+
     def formCells(self, min_angle, printArgs=(True, False)):
-        self.cellsProcessor = CellsProcessor(self.hits, min_angle)
-        self.cellsProcessor.form(*printArgs)
+        with self.instrument("cells") as record:
+            self._formCells(min_angle, printArgs, record)
+
+    def _formCells(self, min_angle, printArgs, record):
+        self.cellsProcessor = CellsProcessor(
+            self.hits, min_angle, max_temp_bytes=self.max_temp_bytes
+        )
+
+        key = self.stage_key("cells", self.hits_key, min_angle)
+        result = self.cached_result(key)
+
+        if result is None:
+            self.cellsProcessor.form(*printArgs)
+            self.cache_result(
+                key,
+                {
+                    "cells": self.cellsProcessor.cells,
+                    "cells_positions": self.cellsProcessor.cells_positions,
+                    "cells_angles": self.cellsProcessor.cells_angles,
+                    "layer_ids": np.array(
+                        list(self.cellsProcessor.cells_per_layer.keys()), dtype=np.int64
+                    ),
+                    "layer_bounds": np.array(
+                        list(self.cellsProcessor.cells_per_layer.values()),
+                        dtype=np.int64,
+                    ).reshape(-1, 2),
+                    "pair_counts": self.counts_array(
+                        self.cellsProcessor.pair_counts, 4
+                    ),
+                },
+            )
+        else:
+            record["cached"] = True
+            self.cellsProcessor.cells = result["cells"]
+            self.cellsProcessor.cells_positions = result["cells_positions"]
+            self.cellsProcessor.cells_angles = result["cells_angles"]
+            self.cellsProcessor.cells_per_layer = dict(
+                zip(result["layer_ids"].tolist(), result["layer_bounds"].tolist())
+            )
+            self.cellsProcessor.pair_counts = self.counts_dict(result["pair_counts"])
+
+            if printArgs[0]:
+                print("{0} cells read from cache.".format(result["cells"].shape[0]))
+                print("")
+
+        self.stage_keys["cells"] = key
+        record["counters"]["pair_counts"] = self.cellsProcessor.pair_counts
 
     def findNeighbours(self, max_angle, printArgs=(True, False)):
+        with self.instrument("neighbours") as record:
+            self._findNeighbours(max_angle, printArgs, record)
+
+    def _findNeighbours(self, max_angle, printArgs, record):
         if not hasattr(self, "cellsProcessor"):
             print("Must call formCells before finding neighbours.")
             return
 
-        self.neighboursProcessor = NeighboursProcessor(self.cellsProcessor, max_angle)
-        self.neighboursProcessor.find_neighbours(*printArgs)
+        self.neighboursProcessor = NeighboursProcessor(
+            self.cellsProcessor, max_angle, self.max_temp_bytes
+        )
+
+        key = self.stage_key("neighbours", self.stage_keys["cells"], max_angle)
+        result = self.cached_result(key)
+
+        if result is None:
+            self.neighboursProcessor.find_neighbours(*printArgs)
+            self.cache_result(
+                key,
+                {
+                    "indptr": self.neighboursProcessor.CA.indptr,
+                    "indices": self.neighboursProcessor.CA.indices,
+                    "neighbours_angles": self.neighboursProcessor.neighbours_angles,
+                    "connection_counts": self.counts_array(
+                        self.neighboursProcessor.connection_counts, 5
+                    ),
+                },
+            )
+        else:
+            record["cached"] = True
+            self.neighboursProcessor.CA = CellularAutomaton(
+                result["indptr"], result["indices"]
+            )
+            self.neighboursProcessor.neighbours_angles = result["neighbours_angles"]
+            self.neighboursProcessor.connection_counts = self.counts_dict(
+                result["connection_counts"]
+            )
+
+            if printArgs[0]:
+                print(
+                    "{0} neighbours read from cache.".format(result["indices"].shape[0])
+                )
+                print("")
+
+        self.stage_keys["neighbours"] = key
         self.CA = self.neighboursProcessor.CA
+        record["counters"][
+            "connection_counts"
+        ] = self.neighboursProcessor.connection_counts
 
     def evolve(self, printArgs=(True, False)):
+        with self.instrument("evolution") as record:
+            self._evolve(printArgs, record)
+
+    def _evolve(self, printArgs, record):
         if not hasattr(self, "neighboursProcessor"):
             print("Must call findNeighbours before evolving.")
             return
 
-        self.evolutionProcessor = EvolutionProcessor(self.neighboursProcessor)
-        self.evolutionProcessor.evolve(*printArgs)
+        self.evolutionProcessor = EvolutionProcessor(
+            self.neighboursProcessor, self.n_workers
+        )
+
+        key = self.stage_key("evolution", self.stage_keys["neighbours"])
+        result = self.cached_result(key)
+
+        if result is None:
+            self.evolutionProcessor.evolve(*printArgs)
+            self.cache_result(
+                key,
+                {
+                    "states": self.evolutionProcessor.CA.states,
+                    "iteration_times": np.array(
+                        self.evolutionProcessor.iteration_times
+                    ),
+                },
+            )
+        else:
+            record["cached"] = True
+            self.evolutionProcessor.CA = self.neighboursProcessor.CA.with_states(
+                result["states"]
+            )
+            self.evolutionProcessor.iteration_times = result["iteration_times"].tolist()
+            self.evolutionProcessor.iterations = len(
+                self.evolutionProcessor.iteration_times
+            )
+
+            if printArgs[0]:
+                print("Evolution read from cache.")
+                print("")
+
+        self.stage_keys["evolution"] = key
         self.CA = self.evolutionProcessor.CA
+        record["counters"]["iterations"] = self.evolutionProcessor.iterations
+
+    @property
+    def hits_key(self):
+        """
+        Fingerprint of the hit arrays read by the algorithm (computed once)
+        """
+        if not hasattr(self, "_hits_key"):
+            self._hits_key = StageCache.fingerprint(
+                *[
+                    self.hits[column].to_numpy()
+                    for column in ["hit_id", "x", "y", "z", "layer_id"]
+                ]
+            )
+
+        return self._hits_key
 
-    def generateTracks(self, min_length, printArgs=(True, False)):
+    def stage_key(self, stage, *inputs):
+        """
+        Cache key of a stage from its inputs (keys of the previous stage and parameters),
+        None if there is no stage cache
+        """
+        if self.stage_cache is None:
+            return None
+
+        return StageCache.fingerprint(stage, *inputs)
+
+    def cached_result(self, key):
+        if self.stage_cache is None:
+            return None
+
+        return self.stage_cache.get(key)
+
+    def cache_result(self, key, result):
+        if self.stage_cache is not None:
+            self.stage_cache.put(key, result)
+
+    @staticmethod
+    def counts_array(counts, n_columns):
+        """
+        Turns counts of shape {(layer_ids): (counts)} into an int64 array
+        of shape (entry, n_columns), each row being the layer ids then the counts
+        """
+        rows = [tuple(layers) + tuple(values) for layers, values in counts.items()]
+
+        return np.array(rows, dtype=np.int64).reshape(-1, n_columns)
+
+    @staticmethod
+    def counts_dict(array):
+        """
+        Inverse of counts_array, whose rows end with 2 counts
+        """
+        return {tuple(row[:-2]): tuple(row[-2:]) for row in array.tolist()}
+
+    def generateTracks(self, min_length, printArgs=(True, False), resolve=False):
+        with self.instrument("tracks") as record:
+            self._generateTracks(min_length, printArgs, resolve, record)
+
+    def _generateTracks(self, min_length, printArgs, resolve, record):
         if not hasattr(self, "evolutionProcessor"):
             print("Must call evolve before generating tracks.")
             return
 
-        self.tracksProcessor = TracksProcessor(self.evolutionProcessor, min_length)
-        self.tracksProcessor.generate(*printArgs)
+        self.tracksProcessor = TracksProcessor(
+            self.evolutionProcessor, min_length, self.n_workers
+        )
+        self.tracksProcessor.generate(*printArgs, resolve=resolve)
         self.tracks = self.tracksProcessor.tracks
+        record["counters"]["candidate_counts"] = self.tracksProcessor.candidate_counts
+
+    @property
+    def peak_temp_bytes(self):
+        """
+        Largest amount of temporaries (bytes) used at once by each stage run so far, of shape
+        {
+            [stage]: bytes
+        }
+        These are estimates, from the number of elements of the temporaries and the bytes
+        each takes (see CellsProcessor and NeighboursProcessor), not measurements.
+        """
+        processors = {
+            "cells": "cellsProcessor",
+            "neighbours": "neighboursProcessor",
+        }
 
+        return {
+            stage: getattr(self, attr_name).peak_temp_bytes
+            for stage, attr_name in processors.items()
+            if hasattr(self, attr_name)
+        }
@@ -13,3 +13,4 @@ from CCA.algorithm.processors.cells_processor import CellsProcessor
 from CCA.algorithm.processors.neighbours_processor import NeighboursProcessor
 from CCA.algorithm.processors.evolution_processor import EvolutionProcessor
 from CCA.algorithm.processors.tracks_processor import TracksProcessor
+from CCA.algorithm.processors.sweep_processor import SweepProcessor
@@ -1,5 +1,7 @@
 import numpy as np
 
+from CCA.data.custom_tools import expand_ranges, split_blocks
+
 
 class CellsProcessor:
     """
@@ -16,20 +18,54 @@ class CellsProcessor:
                         ]
         }
     - cells_positions: has dimensionality (cell, hit, hit_coordinates). The cells and the hits
+    - cells_angles: the cone angle of each cell, i.e. the angle between its inner hit's
+        direction from the origin and the cell (the cell is formed iff it is below min_angle)
     
     """
 
-    def __init__(self, hits, min_angle):
+    # Width of the polar angle bins of the binned pair search, as a fraction of min_angle
+    theta_bin_fraction = 0.25
+
+    # Maximum number of polar angle bins, the bins being widened beyond it (small min_angle)
+    # so that the loop over the bins stays short
+    max_theta_bins = 256
+
+    # Safety margin (rad) on the search windows, so that rounding never drops a pair
+    search_margin = 1e-6
+
+    # Number of floats (and booleans) of temporaries allocated by is_in_cone
+    # (and the gathering of positions) per tested hit pair
+    floats_per_tested_pair = 22
+    bools_per_tested_pair = 3
+
+    def __init__(self, hits, min_angle, pair_search="binned", max_temp_bytes=None):
         """
         hits: Hits class instance
         min_angle: (float) minimum cone angle allowed between two hits to form a pair
+        pair_search: "binned" | "mesh". How the hit pairs of two layers are searched:
+            - "binned": only outer hits in the (theta, phi) window reachable by the cone are tested
+            - "mesh": every inner x outer combination is tested (brute force)
+            Both give identical cells.
+        max_temp_bytes: None | int, memory budget of the temporaries of the pair tests.
+            Hit pairs are tested in blocks of inner hits that fit the budget.
         """
         self.hits = hits
         self.min_angle = min_angle
+        self.pair_search = pair_search
+        self.max_temp_bytes = max_temp_bytes
+
+        # Largest amount of temporaries (bytes) used by a block of pair tests,
+        # as estimated from the number of tested pairs (see tested_pair_bytes)
+        self.peak_temp_bytes = 0
+
+        # Number of hit pairs tested (with is_in_cone) and of cells formed, of shape
+        # {(inner_layer_id, outer_layer_id): (tested, formed)}
+        self.pair_counts = {}
 
         self.cells = np.array([])
         self.cells_per_layer = {}
         self.cells_positions = np.array([])
+        self.cells_angles = np.array([])
 
     def __str__(self):
         return str(self.cells)
@@ -62,11 +98,16 @@ class CellsProcessor:
         """
         print("Forming pairs...")
 
-        layer_ids = self.hits["layer_id"].drop_duplicates().to_list()
-        layer_ids.sort()
+        self.peak_temp_bytes = 0
+        self.pair_counts = {}
+
+        # Hits sorted by layer, each layer being a contiguous slice
+        layer_index = self.hits.get_layer_index()
+        layer_ids = layer_index.layer_ids.tolist()
 
         cells = []
         cells_positions = []
+        cells_n = 0
 
         # Creating dictionary to map layers to their cells
         # The format will be {"layer_id": [index of 1st cell of that layer in cells array, index of last cell of that layer in cells array]}
@@ -82,64 +123,270 @@ class CellsProcessor:
             outer_layer_id = layer_ids[i + 1]
 
             # Loading hits for each layer of the layer pair
-            inner_hits = self.hits[self.hits["layer_id"] == inner_layer_id][
-                ["hit_id", "x", "y", "z"]
-            ].to_numpy()
-            outer_hits = self.hits[self.hits["layer_id"] == outer_layer_id][
-                ["hit_id", "x", "y", "z"]
-            ].to_numpy()
+            inner_hit_ids, inner_hits_pos = layer_index.layer(inner_layer_id)
+            outer_hit_ids, outer_hits_pos = layer_index.layer(outer_layer_id)
 
             # For "cells_per_layer"
-            cells_n_before = len(cells)
+            cells_n_before = cells_n
 
-            # Mesh grid of positions (manually done because couldn't np.meshgrid to work for 2D arrays)
-            inner_hits_pos = inner_hits[:, 1:]
-            outer_hits_pos = outer_hits[:, 1:]
-            inner_hits_pos_mesh = np.tile(
-                inner_hits_pos[:, np.newaxis, :], (1, outer_hits.shape[0], 1)
+            # Indices (in the layers) of the inner and outer hits of the pairs
+            if self.pair_search == "mesh":
+                good_inner, good_outer, n_tested = self.find_pairs_mesh(
+                    inner_hits_pos, outer_hits_pos
+                )
+            else:
+                good_inner, good_outer, n_tested = self.find_pairs_binned(
+                    inner_hits_pos, outer_hits_pos
+                )
+
+            if good_inner.shape[0] > 0:
+                # forming pairs, of shape (cell, hit) and (cell, hit, coordinate)
+                pairs_ids = np.stack(
+                    (inner_hit_ids[good_inner], outer_hit_ids[good_outer]), axis=1
+                )
+                pairs_pos = np.stack(
+                    (inner_hits_pos[good_inner], outer_hits_pos[good_outer]), axis=1
+                )
+
+                # Appending to respective arrays
+                cells.append(pairs_ids)
+                cells_positions.append(pairs_pos)
+                cells_n += pairs_ids.shape[0]
+
+            # Storing the location (in the array cells) of the cells
+            # whose 1st hit is in this particular layer
+            cells_per_layer[inner_layer_id] = [cells_n_before, cells_n]
+            self.pair_counts[(inner_layer_id, outer_layer_id)] = (
+                n_tested,
+                cells_n - cells_n_before,
             )
+
+        if cells_n > 0:
+            cells = np.concatenate(cells).astype(int)
+            cells_positions = np.concatenate(cells_positions)
+        else:
+            cells = np.empty((0, 2), dtype=int)
+            cells_positions = np.empty((0, 2, 3))
+
+        if final_print:
+            print("{0} cells formed.".format(cells.shape[0]))
+            print("")
+
+        self.cells = cells
+        self.cells_per_layer = cells_per_layer
+        self.cells_positions = cells_positions
+        self.cells_angles = self.cone_angles(cells_positions)
+
+    def find_pairs_mesh(self, inner_hits_pos, outer_hits_pos):
+        """
+        Tests every combination of inner and outer hits.
+
+        returns (inner indices, outer indices) of the hits forming a pair,
+        sorted by inner index, then outer index, and the number of hit pairs tested
+        """
+        n_outer = outer_hits_pos.shape[0]
+        row_bytes = n_outer * self.tested_pair_bytes(inner_hits_pos)
+        row_sizes = np.full(inner_hits_pos.shape[0], row_bytes)
+
+        inner_indices = [np.empty(0, dtype=int)]
+        outer_indices = [np.empty(0, dtype=int)]
+        n_tested = 0
+
+        # Blocks of inner hits (i.e. of rows of the mesh)
+        for start, stop in split_blocks(row_sizes, self.max_temp_bytes):
+            block_pos = inner_hits_pos[start:stop]
+            self.record_temp_bytes((stop - start) * row_bytes)
+            n_tested += (stop - start) * n_outer
+
+            # Mesh grid of positions (manually done because couldn't np.meshgrid to work for 2D arrays)
+            inner_hits_pos_mesh = np.tile(block_pos[:, np.newaxis, :], (1, n_outer, 1))
             outer_hits_pos_mesh = np.tile(
-                outer_hits_pos[np.newaxis, :, :], (inner_hits.shape[0], 1, 1)
+                outer_hits_pos[np.newaxis, :, :], (block_pos.shape[0], 1, 1)
             )
 
             # Calculating whether in the inner hit's cone in a batch
             are_good = self.is_in_cone(
-                inner_hits_pos_mesh, outer_hits_pos_mesh, inner_hits_pos
+                inner_hits_pos_mesh, outer_hits_pos_mesh, block_pos
             )
 
             # Getting the corresponding cells
             good_hit_indices = np.argwhere(are_good)
 
-            if good_hit_indices.shape[0] > 0:
-                good_inner_hits = inner_hits[good_hit_indices[:, 0]]
-                good_outer_hits = outer_hits[good_hit_indices[:, 1]]
+            inner_indices.append(good_hit_indices[:, 0] + start)
+            outer_indices.append(good_hit_indices[:, 1])
 
-                # forming pairs
-                pairs = np.array([good_inner_hits, good_outer_hits])
-                pairs = np.transpose(pairs, axes=(1, 0, 2))
+        return np.concatenate(inner_indices), np.concatenate(outer_indices), n_tested
 
-                # Separating hit ids and hit positions
-                pairs_ids = pairs[:, :, 0]
-                pairs_pos = pairs[:, :, 1:]
+    def find_pairs_binned(self, inner_hits_pos, outer_hits_pos):
+        """
+        Tests each inner hit only against the outer hits its cone can reach.
+
+        Any point of the cone (tip at the inner hit, axis pointing away from the origin)
+        lies within min_angle of the inner hit as seen from the origin. So, for an inner hit
+        at polar angle theta and azimuth phi, candidates have:
+        - a polar angle within theta +- min_angle
+        - an azimuth within phi +- arcsin(sin(min_angle) / sin(theta)) (with wrap-around),
+        or any azimuth if the cone contains the z axis
+
+        The outer hits are binned in polar angle and sorted by azimuth within a bin,
+        such that the candidates of an inner hit are a contiguous range of each bin it reaches.
+        The candidates are then tested exactly with is_in_cone (in blocks within max_temp_bytes).
+
+        returns (inner indices, outer indices) of the hits forming a pair,
+        sorted by inner index, then outer index (i.e. identical to find_pairs_mesh),
+        and the number of hit pairs tested
+        """
+        n_inner = inner_hits_pos.shape[0]
+        n_outer = outer_hits_pos.shape[0]
 
-                # Appending to respective arrays
-                cells.extend(pairs_ids)
-                cells_positions.extend(pairs_pos)
+        if n_inner == 0 or n_outer == 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int), 0
 
-            # Storing the location (in the array cells) of the cells
-            # whose 1st hit is in this particular layer
-            cells_per_layer[inner_layer_id] = [cells_n_before, len(cells)]
+        angle = self.min_angle + self.search_margin
 
-        cells = np.array(cells, dtype=int)
-        cells_positions = np.array(cells_positions)
+        theta_inner, phi_inner = self.polar_angles(inner_hits_pos)
+        theta_outer, phi_outer = self.polar_angles(outer_hits_pos)
 
-        if final_print:
-            print("{0} cells formed.".format(cells.shape[0]))
-            print("")
+        # Azimuthal half-width of the window of each inner hit
+        contains_axis = (theta_inner <= angle) | (theta_inner >= np.pi - angle)
+        half_width = np.full(n_inner, np.pi)
+        half_width[~contains_axis] = np.arcsin(
+            np.minimum(np.sin(angle) / np.sin(theta_inner[~contains_axis]), 1)
+        )
 
-        self.cells = cells
-        self.cells_per_layer = cells_per_layer
-        self.cells_positions = cells_positions
+        # Binning outer hits in polar angle, then sorting them by azimuth within each bin
+        theta_min = theta_outer.min()
+        theta_range = theta_outer.max() - theta_min
+        bin_width = max(
+            self.theta_bin_fraction * angle, theta_range / self.max_theta_bins
+        )
+        n_bins = int(theta_range // bin_width) + 1
+        bins = ((theta_outer - theta_min) // bin_width).astype(int)
+
+        order = np.lexsort((phi_outer, bins))
+        bin_bounds = np.searchsorted(bins[order], np.arange(n_bins + 1))
+        sorted_phi_outer = phi_outer[order]
+
+        pair_bytes = self.tested_pair_bytes(inner_hits_pos)
+
+        inner_indices = []
+        outer_indices = []
+        n_tested = 0
+
+        for b in range(n_bins):
+            start, stop = bin_bounds[b], bin_bounds[b + 1]
+            n_bin = stop - start
+
+            if n_bin == 0:
+                continue
+
+            # Inner hits whose polar angle window overlaps with the bin
+            bin_low = theta_min + b * bin_width
+            bin_high = bin_low + bin_width
+            reaching = np.flatnonzero(
+                (theta_inner - angle <= bin_high) & (theta_inner + angle >= bin_low)
+            )
+
+            if reaching.shape[0] == 0:
+                continue
+
+            # Azimuths of the bin repeated over [pi, 3pi) to handle the wrap-around
+            bin_phi = sorted_phi_outer[start:stop]
+            bin_phi = np.concatenate((bin_phi, bin_phi + 2 * np.pi))
+
+            low = phi_inner[reaching] - half_width[reaching]
+            low[low < -np.pi] += 2 * np.pi
+            high = low + 2 * half_width[reaching]
+
+            range_starts = np.searchsorted(bin_phi, low, side="left")
+            range_stops = np.searchsorted(bin_phi, high, side="right")
+
+            # The whole bin for cones containing the z axis
+            whole_bin = contains_axis[reaching]
+            range_starts[whole_bin] = 0
+            range_stops[whole_bin] = n_bin
+
+            # Testing the candidates exactly, in blocks of inner hits that fit the budget
+            candidate_bytes = np.maximum(range_stops - range_starts, 0) * pair_bytes
+
+            for block_start, block_stop in split_blocks(
+                candidate_bytes, self.max_temp_bytes
+            ):
+                block = slice(block_start, block_stop)
+                self.record_temp_bytes(np.sum(candidate_bytes[block]))
+
+                owners, positions = expand_ranges(
+                    range_starts[block], range_stops[block]
+                )
+                n_tested += owners.shape[0]
+                candidates_inner = reaching[block][owners]
+                candidates_outer = order[start + positions % n_bin]
+
+                inner_pos = inner_hits_pos[candidates_inner]
+                outer_pos = outer_hits_pos[candidates_outer]
+                are_good = self.is_in_cone(
+                    inner_pos[:, np.newaxis, :], outer_pos[:, np.newaxis, :], inner_pos
+                )[:, 0]
+
+                inner_indices.append(candidates_inner[are_good])
+                outer_indices.append(candidates_outer[are_good])
+
+        if len(inner_indices) == 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int), n_tested
+
+        inner_indices = np.concatenate(inner_indices)
+        outer_indices = np.concatenate(outer_indices)
+
+        # Same order as the mesh search
+        sort_indices = np.lexsort((outer_indices, inner_indices))
+
+        return inner_indices[sort_indices], outer_indices[sort_indices], n_tested
+
+    def tested_pair_bytes(self, hits_pos):
+        """
+        Bytes of temporaries needed to test one hit pair
+        """
+        return (
+            self.floats_per_tested_pair * hits_pos.dtype.itemsize
+            + self.bools_per_tested_pair
+        )
+
+    def record_temp_bytes(self, n_bytes):
+        self.peak_temp_bytes = max(self.peak_temp_bytes, int(n_bytes))
+
+    @staticmethod
+    def polar_angles(positions):
+        """
+        Returns (theta, phi), the polar angle and azimuth of positions of shape (hit, coordinate)
+        """
+        r = np.linalg.norm(positions, axis=1)
+        theta = np.arccos(np.clip(positions[:, 2] / r, -1, 1))
+        phi = np.arctan2(positions[:, 1], positions[:, 0])
+
+        return theta, phi
+
+    @staticmethod
+    def cone_angles(cells_positions):
+        """
+        Returns the angle between the main axis of the cone of each cell's inner hit
+        (see is_in_cone) and the vector from the inner to the outer hit: the cell is in the cone
+        of an angle iff its cone angle is below it.
+
+        - cells_positions: dimensionality (cell, hit, hit_position_coordinate)
+
+        returns a 1D array of dimensionality (cell)
+        """
+        inner_hits_pos = cells_positions[:, 0, :]
+        r_21 = cells_positions[:, 1, :] - inner_hits_pos
+
+        norm_inner = np.linalg.norm(inner_hits_pos, axis=1)[:, np.newaxis]
+        unit_r_1 = inner_hits_pos / norm_inner
+        cone_dist = np.sum(r_21 * unit_r_1, axis=1)
+        orth_distance = np.linalg.norm(
+            r_21 - cone_dist[:, np.newaxis] * unit_r_1, axis=1
+        )
+
+        return np.arctan2(orth_distance, cone_dist)
 
     def is_in_cone(self, inner_hits_pos_mesh, outer_hits_pos_mesh, inner_hits_pos):
         """
@@ -1,16 +1,66 @@
-from CCA.data import CellularAutomaton
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from CCA.data.custom_tools import expand_ranges
 
 
 class EvolutionProcessor:
-    def __init__(self, neighboursProcessor):
-        self.CA = neighboursProcessor.CA
-        self.cells = neighboursProcessor.cells
+    # Above this fraction of cells in the frontier, it is faster to examine the whole edge
+    # list (with a plain gather) than to gather the frontier's edges
+    dense_frontier_fraction = 0.25
+
+    # With several workers, connected components of fewer cells are evolved together
+    # in the main process rather than sent to a worker process each
+    min_part_cells = 10000
+
+    def __init__(self, neighboursProcessor, n_workers=1):
+        """
+        - n_workers: number of processes evolving the connected components of the CA
+        in parallel (see evolve_parts)
+        """
+        self.set_CA(
+            neighboursProcessor.CA,
+            neighboursProcessor.cells_per_layer,
+            neighboursProcessor.cells,
+            neighboursProcessor.cells_positions,
+        )
+        self.n_workers = n_workers
+
+    @classmethod
+    def from_parts(cls, CA, cells_per_layer, n_workers=1):
+        """
+        Creates the processor of a CA from the cells_per_layer of its cells only, without a
+        NeighboursProcessor (e.g. for a part of a CA evolved in a worker process)
+        """
+        evolutionProcessor = cls.__new__(cls)
+        evolutionProcessor.set_CA(CA, cells_per_layer)
+        evolutionProcessor.n_workers = n_workers
+
+        return evolutionProcessor
 
-    def evolve(self, final_print=True, progress_print=False):
+    def set_CA(self, CA, cells_per_layer, cells=None, cells_positions=None):
+        """
+        Sets the CA to evolve, the layers of its cells (and the cells and their positions,
+        unknown if None)
+        """
+        self.CA = CA
+        self.cells = cells
+        self.cells_positions = cells_positions
+        self.cells_per_layer = cells_per_layer
+
+        # Filled by evolve
+        self.iterations = 0
+        self.iteration_times = []
+
+    def evolve(
+        self, final_print=True, progress_print=False, mode="frontier", check=False
+    ):
         """
         Runs the evolution of the cellular automaton on the cells provided.
 
-        Takes in and returns a dictionary of shape:
+        Takes in and returns a CellularAutomaton, which can be read as a dictionary of shape:
         {
          ["cell_index1"]: {
              "inner_neighs": [arr of cell_indices],
@@ -20,57 +70,296 @@ class EvolutionProcessor:
          ...
         }
 
+        At each (synchronous) iteration, a cell's state is incremented if one of its inner
+        neighbours has the same state as it, until no state changes.
+
+        mode: "frontier" | "sweep" | "dag". All give identical states:
+        - "frontier": each iteration only re-examines the cells whose state, or one of whose
+        inner neighbours' state, changed in the previous iteration
+        - "sweep": each iteration examines every edge of the CA
+        - "dag": the final states are computed directly in one pass over the layers
+        (see evolve_dag)
+        check: if True (and mode is "dag"), asserts that the states are the same as
+        with the iterative "frontier" mode
+
+        Stores the number of iterations in self.iterations and the time (s) each took
+        in self.iteration_times.
         """
         print("Evolving CA...")
 
-        # Creating state dictionaries for faster dict copying (necessitated after each iteration)
-        states_curr = self.CA.states_dict()
-        states_next = states_curr.copy()
+        if self.n_workers > 1:
+            states = self.evolve_parts(mode)
+        else:
+            states = self.evolve_states(mode, progress_print)
+
+        if check and mode == "dag":
+            iterations, iteration_times = self.iterations, self.iteration_times
+            iterative_states = self.evolve_frontier()
+            assert np.array_equal(
+                states, iterative_states
+            ), "DAG evolution doesn't match the iterative evolution."
+            self.iterations, self.iteration_times = iterations, iteration_times
+
+        # Creating final object
+        self.CA = self.CA.with_states(states)
+
+        if final_print:
+            print(
+                "Evolution completed in {0} iterations ({1:.3f}s).".format(
+                    self.iterations, sum(self.iteration_times)
+                )
+            )
+            print("")
+
+    def evolve_states(self, mode="frontier", progress_print=False):
+        """
+        Evolution of the whole CA with the given mode (see evolve)
+
+        returns the final states
+        """
+        if mode == "sweep":
+            return self.evolve_sweep(progress_print)
+        elif mode == "dag":
+            return self.evolve_dag(progress_print)
+        else:
+            return self.evolve_frontier(progress_print)
+
+    def evolve_parts(self, mode="frontier"):
+        """
+        Evolution of each connected component of the CA on its own, since the states of a
+        component don't depend on the other ones. The parts (see CellularAutomaton.partition)
+        of at least min_part_cells cells are evolved in parallel by a pool of n_workers
+        processes, while the smaller components, batched together, are evolved at once
+        in the main process. Without such large parts, the whole CA is evolved at once
+        in the main process (see evolve_states).
+
+        self.iterations is then the largest number of iterations of a part and
+        self.iteration_times the time of each iteration summed over the parts.
+
+        returns the final states
+        """
+        parts = self.CA.partition(self.min_part_cells)
+        layer_bounds = np.array(list(self.cells_per_layer.values()), dtype=np.int64)
+
+        def part_args(cells):
+            # Cells of a layer stay contiguous in the part, as cells are sorted
+            part_bounds = np.searchsorted(cells, layer_bounds)
+            cells_per_layer = dict(
+                zip(self.cells_per_layer.keys(), map(tuple, part_bounds.tolist()))
+            )
+
+            return self.CA.subgraph(cells), cells_per_layer, mode
+
+        large_parts = [
+            cells for cells in parts if cells.shape[0] >= self.min_part_cells
+        ]
+        small_parts = [cells for cells in parts if cells.shape[0] < self.min_part_cells]
+
+        # Nothing to parallelize: evolving the whole CA at once
+        if not large_parts:
+            return self.evolve_states(mode)
 
-        cell_indices = self.CA.keys()
+        with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = [
+                executor.submit(_evolve_part, *part_args(cells))
+                for cells in large_parts
+            ]
+            small_results = [_evolve_part(*part_args(cells)) for cells in small_parts]
+            results = [future.result() for future in futures] + small_results
 
-        iters = 0
+        states = self.CA.states.copy()
+        self.iterations = max([iterations for _, iterations, _ in results], default=0)
+        self.iteration_times = [0.0] * self.iterations
+
+        for cells, (part_states, _, iteration_times) in zip(
+            large_parts + small_parts, results
+        ):
+            states[cells] = part_states
+
+            for i, seconds in enumerate(iteration_times):
+                self.iteration_times[i] += seconds
+
+        return states
+
+    def evolve_sweep(self, progress_print=False):
+        """
+        Evolution over the whole edge list at each iteration
+
+        returns the final states
+        """
+        # Edge list of the CA: inner[i] is an inner neighbour of outer[i]
+        outer, inner = self.CA.edges()
+        states = self.CA.states.copy()
+
+        self.iterations = 0
+        self.iteration_times = []
         state_changed = True
 
         # While the state of at least one cell has changed
         while state_changed:
-            iters += 1
-            state_changed = False
+            start = time.perf_counter()
+            self.iterations += 1
+
+            # Increment the state of the cells that have an inner neighbour with the same state
+            # (synchronous update: all comparisons use the states of the previous iteration)
+            same_state = states[outer] == states[inner]
+            to_increment = np.zeros(states.shape[0], dtype=bool)
+            to_increment[outer[same_state]] = True
+
+            state_changed = bool(np.any(to_increment))
+            states += to_increment
+
+            self.iteration_times.append(time.perf_counter() - start)
 
             if progress_print:
-                print("Iteration", iters)
+                print(
+                    "Iteration {0}: {1} cells changed ({2:.4f}s)".format(
+                        self.iterations,
+                        np.count_nonzero(to_increment),
+                        self.iteration_times[-1],
+                    )
+                )
 
-            # POSSIBLE OPTIMIZATION: could only loop starting at 2nd layer since 1st layer has no inner neighs
+        return states
 
-            # Looping through cells
-            for cell_index in cell_indices:
-                cell_state = states_curr[cell_index]
-                neighs = self.CA[cell_index]["inner_neighs"]
+    def evolve_frontier(self, progress_print=False):
+        """
+        Evolution in which an iteration only examines the "frontier": the cells whose
+        state or one of whose inner neighbours' state changed in the previous iteration.
+        The outcome of the other cells can't have changed (they still don't match any
+        inner neighbour). While the frontier is large, the whole edge list is examined.
 
-                # Looping through inner neighbours of cells
-                for neigh_index in neighs:
-                    neigh_state = states_curr[neigh_index]
+        returns the final states
+        """
+        n_cells = self.CA.n_cells
 
-                    # Increment the state of the cell if one of its inner neighbours
-                    # has the same state as it
-                    if cell_state == neigh_state:
-                        states_next[cell_index] = states_curr[cell_index] + 1
-                        state_changed = True
-                        break
+        # Edge list of the CA: inner[i] is an inner neighbour of outer[i] (grouped by outer cell)
+        outer, inner = self.CA.edges()
+        states = self.CA.states.copy()
 
-            states_curr = states_next.copy()
+        # Position of the inner neighbours of each cell in the edge list
+        inner_counts = np.bincount(outer, minlength=n_cells)
+        inner_indptr = np.concatenate(([0], np.cumsum(inner_counts)))
 
-        # Creating final object
-        CA_final = {
-            cell_id: {
-                "state": states_next[cell_id],
-                "inner_neighs": cell["inner_neighs"],
-            }
-            for cell_id, cell in self.CA.items()
-        }
-        self.CA = CellularAutomaton(CA_final)
+        # Outer neighbours of each cell (reverse adjacency)
+        reverse_order = np.argsort(inner, kind="stable")
+        outer_neighs = outer[reverse_order]
+        outer_counts = np.bincount(inner, minlength=n_cells)
+        outer_indptr = np.concatenate(([0], np.cumsum(outer_counts)))
 
-        if final_print:
-            print("Evolution completed.")
-            print("")
+        self.iterations = 0
+        self.iteration_times = []
+
+        # All the cells are examined at the 1st iteration
+        frontier = self.CA.cell_ids
+        n_alive = frontier.shape[0]
+
+        while True:
+            start = time.perf_counter()
+            self.iterations += 1
+            n_examined = frontier.shape[0]
+
+            # Edges of the frontier cells
+            if n_examined > self.dense_frontier_fraction * n_alive:
+                frontier_cells, frontier_neighs = outer, inner
+            else:
+                owners, edge_indices = expand_ranges(
+                    inner_indptr[frontier], inner_indptr[frontier + 1]
+                )
+                frontier_cells = frontier[owners]
+                frontier_neighs = inner[edge_indices]
+
+            # Increment the state of the cells that have an inner neighbour with the same state
+            # (synchronous update: all comparisons use the states of the previous iteration)
+            same_state = states[frontier_cells] == states[frontier_neighs]
+            is_changed = np.zeros(n_cells, dtype=bool)
+            is_changed[frontier_cells[same_state]] = True
+            changed = np.flatnonzero(is_changed)
+            states[changed] += 1
+
+            if changed.shape[0] > 0:
+                # Next frontier: changed cells and their outer neighbours
+                _, reverse_indices = expand_ranges(
+                    outer_indptr[changed], outer_indptr[changed + 1]
+                )
+                is_changed[outer_neighs[reverse_indices]] = True
+                frontier = np.flatnonzero(is_changed)
+
+            self.iteration_times.append(time.perf_counter() - start)
+
+            if progress_print:
+                print(
+                    "Iteration {0}: {1} cells examined, {2} changed ({3:.4f}s)".format(
+                        self.iterations,
+                        n_examined,
+                        changed.shape[0],
+                        self.iteration_times[-1],
+                    )
+                )
+
+            # Until no state has changed
+            if changed.shape[0] == 0:
+                break
+
+        return states
+
+    def evolve_dag(self, progress_print=False):
+        """
+        Single-pass evolution. Since inner neighbours of a cell always are cells of the
+        previous layer, the CA is a layered directed acyclic graph, and the evolution converges
+        to each cell's state being 1 + the length of the longest chain of inner neighbours
+        starting from it, i.e.
+            state = 1 + max(state of inner neighbours) (1 if it has none)
+        Going through the layers from the innermost, the inner neighbours' final states are
+        known when a layer is processed, so each edge is visited once.
+
+        Assumes that all states start at 1 (as set by NeighboursProcessor).
+
+        returns the final states
+        """
+        start = time.perf_counter()
+
+        n_cells = self.CA.n_cells
+
+        # Edge list of the CA: inner[i] is an inner neighbour of outer[i] (grouped by outer cell)
+        outer, inner = self.CA.edges()
+        states = self.CA.states.copy()
+
+        # Position of the inner neighbours of each cell in the edge list
+        inner_counts = np.bincount(outer, minlength=n_cells)
+        inner_indptr = np.concatenate(([0], np.cumsum(inner_counts)))
+
+        # Cells of a layer are contiguous in "cells", and layers are in increasing order
+        layer_cells = sorted(self.cells_per_layer.values())
+        for i, (first_cell, last_cell) in enumerate(layer_cells):
+            edges = slice(inner_indptr[first_cell], inner_indptr[last_cell])
+
+            if progress_print:
+                print(
+                    "Processing layer {0}/{1} ({2} edges).".format(
+                        i + 1, len(layer_cells), edges.stop - edges.start
+                    )
+                )
+
+            np.maximum.at(states, outer[edges], states[inner[edges]] + 1)
+
+        self.iterations = 1
+        self.iteration_times = [time.perf_counter() - start]
+
+        return states
+
+
+def _evolve_part(CA, cells_per_layer, mode):
+    """
+    Evolves a part of a CA (see EvolutionProcessor.evolve_parts), in a worker process
+
+    returns (states, iterations, iteration_times)
+    """
+    evolutionProcessor = EvolutionProcessor.from_parts(CA, cells_per_layer)
+    states = evolutionProcessor.evolve_states(mode)
 
+    return (
+        states,
+        evolutionProcessor.iterations,
+        evolutionProcessor.iteration_times,
+    )
@@ -1,4 +1,5 @@
 from CCA.data.cellular_automaton import CellularAutomaton
+from CCA.data.custom_tools import cell_angles, expand_ranges, split_blocks
 import numpy as np
 
 
@@ -11,19 +12,49 @@ class NeighboursProcessor:
     - cells, cells_per_layer, cells_positions: from cellsProcessor provided on init
     - max_angle: the maximum angle allowed between two cells for them to be neighbours
     - CA: holds the cellular automaton formed by find_neighbours
+    - neighbours_angles: the angle between the cells of each edge of CA, in the order of
+        CA.edges() (the cells are neighbours iff it is at most max_angle)
     """
 
-    def __init__(self, cellsProcessor, max_angle):
+    # Bytes of temporaries (two hit id meshes and the equality matrix) per tested cell pair
+    mesh_bytes_per_element = 17
+
+    # Bytes of temporaries (cell indices, positions and the angle computation) per connected cell pair
+    bytes_per_connection = 224
+
+    def __init__(
+        self, cellsProcessor, max_angle, max_temp_bytes=None, matching="join"
+    ):
         """
             hits: Hits class instance
             min_angle: (float) minimum cone angle allowed between two hits to form a pair
+            max_temp_bytes: None | int, memory budget of the temporaries of the connection tests.
+                Cells are tested in blocks that fit the budget. It is best-effort: the
+                sort and search of the "join" matching aren't split in blocks, and can
+                exceed it (peak_temp_bytes then tells by how much).
+            matching: "join" | "mesh". How connected cells (sharing a hit) of two layers are found:
+                - "join": inner cells are matched to outer cells sorted by their inner hit id
+                - "mesh": every inner x outer combination is compared (brute force)
+                Both give identical neighbours.
             """
         self.max_angle = max_angle
-        self.CA = CellularAutomaton({})
+        self.max_temp_bytes = max_temp_bytes
+        self.matching = matching
+        self.CA = CellularAutomaton.from_edges(0, [], [])
+        self.neighbours_angles = np.array([])
+
+        # Largest amount of temporaries (bytes) used by a block of connection tests, as
+        # estimated from their number of elements (see mesh_bytes_per_element)
+        self.peak_temp_bytes = 0
+
+        # Number of connected cell pairs and of those that are neighbours (angle accepted),
+        # of shape {(inner_layer_id, mid_layer_id, outer_layer_id): (connected, neighbours)}
+        self.connection_counts = {}
 
         self.cells = cellsProcessor.cells
         self.cells_per_layer = cellsProcessor.cells_per_layer
         self.cells_positions = cellsProcessor.cells_positions
+        self.cells_angles = cellsProcessor.cells_angles
         self.hits = cellsProcessor.hits
 
     def __str__(self):
@@ -37,12 +68,11 @@ class NeighboursProcessor:
         """
         Finds the neighbours among the cells provided.
 
-        Stores in self.CA an (augmented) dictionary of shape
+        Stores in self.CA a CellularAutomaton, which can be read as a dictionary of shape
         {
          ["cell_index1"]: {
              "inner_neighs": [arr of cell_indices],
              "state": integer,
-             "hit_positions": 
          },
          ["cell_index2"]: {...},
          ...
@@ -55,16 +85,14 @@ class NeighboursProcessor:
         """
         print("Finding Neighbours...")
 
+        self.peak_temp_bytes = 0
+        self.connection_counts = {}
+
         layer_ids = self.hits.layer_ids
         hit_ids = self.hits.hit_ids
 
-        # will store the neighbours and state of the cells
-        CA = {
-            cell_index: {"state": 1, "inner_neighs": []}
-            for cell_index in range(self.cells.shape[0])
-        }
-
         neighs = []
+        neighs_angles = []
 
         # Looping over all layers (except the 1st and last)
         for i in range(1, len(layer_ids) - 1):
@@ -87,73 +115,152 @@ class NeighboursProcessor:
             hits_inner = inner_cells[:, 1]
             hits_outer = outer_cells[:, 0]
 
-            # Creating a meshgrid of them
-            hits_outer_mesh, hits_inner_mesh = np.meshgrid(hits_outer, hits_inner)
-
-            # Checking whether they match all at once
-            are_connected = hits_inner_mesh == hits_outer_mesh
-            are_connected_indices = np.argwhere(are_connected)
+            # Indices (in the layers) of the inner and outer cells that are connected
+            if self.matching == "mesh":
+                connected_inner, connected_outer = self.find_connected_mesh(
+                    hits_inner, hits_outer
+                )
+            else:
+                connected_inner, connected_outer = self.find_connected_join(
+                    hits_inner, hits_outer
+                )
 
             # Fixing the indexing to reflect index in "cells" (instead of a particular layer in "cells")
-            are_connected_indices[:, 0] += inner_cell_bounds[0]
-            are_connected_indices[:, 1] += outer_cell_bounds[0]
+            are_connected_indices = np.stack(
+                (
+                    connected_inner + inner_cell_bounds[0],
+                    connected_outer + outer_cell_bounds[0],
+                ),
+                axis=1,
+            )
 
             #    Note: Now, in "are_neighs_indices"'s 2nd dimension, the 1st location corresponds to the
             #    inner cell, and the 2nd location to the outer cell, for every cells that are neighbours
 
             # STEP 2: CHECK ALL AT ONCE WHETHER THE ANGLE BETWEEN CONNECTED CELLS LIES BELOW A MAXIMUM ANGLE
-            have_ok_angle_indices = self.check_angles(
-                are_connected_indices, self.cells_positions, self.max_angle
+            # (in blocks of connections that fit the budget)
+            connection_sizes = np.full(
+                are_connected_indices.shape[0], self.bytes_per_connection
             )
+            n_neighs = 0
+            for start, stop in split_blocks(connection_sizes, self.max_temp_bytes):
+                self.record_temp_bytes((stop - start) * self.bytes_per_connection)
+
+                block_indices = are_connected_indices[start:stop]
+                have_ok_angle_indices, ok_angles = self.check_angles(
+                    block_indices, self.cells_positions, self.max_angle, True
+                )
+
+                # "are_neighs_indices" are the cell pairs that are both connected and have an angle below the threshold
+                are_neighs_indices = block_indices[have_ok_angle_indices]
 
-            # "are_neighs_indices" are the cell pairs that are both connected and have an angle below the threshold
-            are_neighs_indices = are_connected_indices[have_ok_angle_indices]
+                neighs.append(are_neighs_indices)
+                neighs_angles.append(ok_angles)
+                n_neighs += are_neighs_indices.shape[0]
 
-            neighs.extend(are_neighs_indices)
+            triad = (inner_layer_id, mid_layer_id, layer_ids[i + 1])
+            self.connection_counts[triad] = (are_connected_indices.shape[0], n_neighs)
 
-        neighs = np.array(neighs)
+        neighs = np.concatenate(neighs) if neighs else np.empty((0, 2), dtype=int)
+        neighs_angles = np.concatenate(neighs_angles) if neighs_angles else np.empty(0)
 
-        # STEP 3: ADD THE NEIGHBOURS TO "CA"
-        for i in range(neighs.shape[0]):
-            inner_neigh = neighs[i, 0]
-            outer_neigh = neighs[i, 1]
+        # STEP 3: FORM THE CA (all states init to 1) FROM THE NEIGHBOURS
+        self.CA = CellularAutomaton.from_edges(
+            self.cells.shape[0], neighs[:, 1], neighs[:, 0]
+        )
 
-            CA[outer_neigh]["inner_neighs"].append(inner_neigh)
+        # Same (stable) ordering of the edges by outer cell as the CA
+        self.neighbours_angles = neighs_angles[np.argsort(neighs[:, 1], kind="stable")]
 
         if final_print:
             print("{0} neighbours found.".format(neighs.shape[0]))
             print("")
 
-        self.CA = CellularAutomaton(CA)
+    def find_connected_join(self, hits_inner, hits_outer):
+        """
+        Joins inner cells to the outer cells whose inner hit is their outer hit,
+        by sorting outer cells by inner hit id and searching each inner cell's outer hit id.
+        Takes O(C log C) time and memory proportional to the number of connections.
+        It isn't split in blocks: its temporaries are recorded, but can exceed
+        max_temp_bytes.
+
+        - hits_inner: outer hit ids of the inner cells
+        - hits_outer: inner hit ids of the outer cells
+
+        returns (inner indices, outer indices) of connected cells,
+        sorted by inner index, then outer index
+        """
+        # Stable sort, such that outer cells sharing a hit stay in increasing order
+        order = np.argsort(hits_outer, kind="stable")
+        sorted_hits_outer = hits_outer[order]
+
+        range_starts = np.searchsorted(sorted_hits_outer, hits_inner, side="left")
+        range_stops = np.searchsorted(sorted_hits_outer, hits_inner, side="right")
+
+        connected_inner, positions = expand_ranges(range_starts, range_stops)
+        connected_outer = order[positions]
+
+        self.record_temp_bytes(
+            order.nbytes + sorted_hits_outer.nbytes + 2 * range_starts.nbytes
+        )
+
+        return connected_inner, connected_outer
 
-    def check_angles(self, cell_pairs, cells_positions, max_angle):
+    def find_connected_mesh(self, hits_inner, hits_outer):
+        """
+        Compares all inner and outer cells, in blocks of inner cells that fit the budget.
+
+        - hits_inner: outer hit ids of the inner cells
+        - hits_outer: inner hit ids of the outer cells
+
+        returns (inner indices, outer indices) of connected cells,
+        sorted by inner index, then outer index
+        """
+        row_bytes = hits_outer.shape[0] * self.mesh_bytes_per_element
+        row_sizes = np.full(hits_inner.shape[0], row_bytes)
+
+        connected_inner = [np.empty(0, dtype=int)]
+        connected_outer = [np.empty(0, dtype=int)]
+
+        # Blocks of inner cells (i.e. of rows of the mesh)
+        for start, stop in split_blocks(row_sizes, self.max_temp_bytes):
+            self.record_temp_bytes((stop - start) * row_bytes)
+
+            # Creating a meshgrid of them
+            hits_outer_mesh, hits_inner_mesh = np.meshgrid(
+                hits_outer, hits_inner[start:stop]
+            )
+
+            # Checking whether they match all at once
+            are_connected = hits_inner_mesh == hits_outer_mesh
+            are_connected_indices = np.argwhere(are_connected)
+
+            connected_inner.append(are_connected_indices[:, 0] + start)
+            connected_outer.append(are_connected_indices[:, 1])
+
+        return np.concatenate(connected_inner), np.concatenate(connected_outer)
+
+    def record_temp_bytes(self, n_bytes):
+        self.peak_temp_bytes = max(self.peak_temp_bytes, int(n_bytes))
+
+    def check_angles(self, cell_pairs, cells_positions, max_angle, return_angles=False):
         """
         Checks whether the angle between each pair of cells is below "max_angle" (gives True if it is)
 
         - cell_pairs: dimensionality (pair, cell index)
         - max_angle: the maximum allowed angle (float number)
         - cells_positions: array of shape (cell, hit, hit_position_coordinate)
+        - return_angles: if True, the angles of the pairs below max_angle are also returned
 
         returns a 1D array of dimensionality (pair)
         """
-        #    dimensionality: (connectedPairOfCells, cell (in pair), hit (in cell), position coordinate (of hit))
-        positions = cells_positions[cell_pairs]
-
-        # Computing vectors going from inner to outer hit for each cell
-        #    dimensionality: (connectedPairOfCells, cell (in pair), position coordinate (of vector))
-        vec_diffs = positions[:, :, 1, :] - positions[:, :, 0, :]
-
-        # Computing the magnitude of all vector differences
-        #    dimensionality: (connectedPairOfCells, cell (in pair))
-        mags = np.linalg.norm(vec_diffs, axis=2)
-
         #    dimensionality: (connectedPairOfCells)
-        dot_prods = np.sum(vec_diffs[:, 0] * vec_diffs[:, 1], axis=1)
-
-        #    dimensionality: (connectedPairOfCells)
-        angles = np.arccos(dot_prods / (mags[:, 0] * mags[:, 1]))
+        angles = cell_angles(cell_pairs, cells_positions)
 
         have_ok_angle = angles <= max_angle
         have_ok_angle_indices = np.argwhere(have_ok_angle)[:, 0]
 
+        if return_angles:
+            return have_ok_angle_indices, angles[have_ok_angle_indices]
+
         return have_ok_angle_indices
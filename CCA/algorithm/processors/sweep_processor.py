@@ -0,0 +1,152 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from CCA.algorithm.evaluators.cells_evaluator import CellsEvaluator
+from CCA.algorithm.evaluators.neighbours_evaluator import NeighboursEvaluator
+from CCA.algorithm.evaluators.tracks_evaluator import TracksEvaluator
+from CCA.data.tracks import Tracks
+from .CCA_processor import CCAProcessor
+from .tracks_processor import TracksProcessor
+
+
+class SweepProcessor:
+    """
+    Runs the CCA algorithm and its evaluation over a grid of parameters
+    (cell_angle, neigh_angle, min_track_length) for many events.
+
+    Each stage result is computed once and shared by all the grid points depending on it:
+        cells(cell_angle)
+        -> neighbours(neigh_angle) -> evolution
+        -> tracks(min_track_length)
+    The tracks are even generated once per evolution, with the smallest min_track_length:
+    since track lengths are processed from the longest, the tracks of a larger minimum length
+    are the ones of length at least that minimum.
+
+    The branches of the stage graph of each (event, cell_angle) are independent, and are
+    spread over a pool of n_workers processes. The branches of an event are collected
+    while the next event's ones run, so that only two events are in flight at once.
+    """
+
+    def __init__(self, dataProcessor, n_workers=1, max_temp_bytes=None):
+        """
+        - dataProcessor: DataProcessor the events are read and processed with
+        - n_workers: number of processes running the (event, cell_angle) branches in parallel
+        - max_temp_bytes: see CCAProcessor
+        """
+        self.dataProcessor = dataProcessor
+        self.n_workers = n_workers
+        self.max_temp_bytes = max_temp_bytes
+
+    def run(
+        self, event_ids, cell_angles, neigh_angles, min_track_lengths, **process_kwargs
+    ):
+        """
+        Runs the grid for each event.
+
+        - process_kwargs: passed to DataProcessor.process_event (pT_min, n_particles, ...)
+
+        returns a DataFrame with one row per event, grid point and stage ("cells",
+        "neighbours", "tracks"), of columns
+        event_id, cell_angle, neigh_angle, min_track_length, stage, efficiency, purity
+        """
+        print("Running sweep...")
+
+        rows = []
+        previous_branches = []
+        with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+            for event_id, hits, truth in self.dataProcessor.iter_processed(
+                event_ids, **process_kwargs
+            ):
+                branches = [
+                    executor.submit(
+                        _run_branch,
+                        event_id,
+                        hits,
+                        truth,
+                        cell_angle,
+                        list(neigh_angles),
+                        list(min_track_lengths),
+                        self.max_temp_bytes,
+                    )
+                    for cell_angle in cell_angles
+                ]
+
+                # Collecting the previous event's branches while this event's ones run,
+                # so that the workers hold at most two events besides the ones
+                # prefetched by iter_processed
+                rows += [row for branch in previous_branches for row in branch.result()]
+                previous_branches = branches
+
+            rows += [row for branch in previous_branches for row in branch.result()]
+
+        return pd.DataFrame(
+            rows,
+            columns=[
+                "event_id",
+                "cell_angle",
+                "neigh_angle",
+                "min_track_length",
+                "stage",
+                "efficiency",
+                "purity",
+            ],
+        )
+
+
+def _run_branch(
+    event_id, hits, truth, cell_angle, neigh_angles, min_track_lengths, max_temp_bytes
+):
+    """
+    Runs all the grid points of an (event, cell_angle) branch (see SweepProcessor),
+    in a worker process
+
+    returns a list of rows (event_id, cell_angle, neigh_angle, min_track_length, stage,
+    efficiency, purity)
+    """
+    printArgs = (False, False)
+    rows = []
+
+    processor = CCAProcessor(hits, max_temp_bytes, quiet=True)
+    processor.formCells(cell_angle, printArgs)
+
+    cellsEval = CellsEvaluator(truth, processor.cellsProcessor)
+    cellsEval.evaluate()
+
+    for neigh_angle in neigh_angles:
+        processor.findNeighbours(neigh_angle, printArgs)
+        processor.evolve(printArgs)
+
+        neighsEval = NeighboursEvaluator(truth, processor.neighboursProcessor)
+        neighsEval.evaluate()
+
+        processor.generateTracks(min(min_track_lengths), printArgs)
+        all_tracks = processor.tracks
+
+        for min_length in min_track_lengths:
+            tracksProcessor = TracksProcessor(processor.evolutionProcessor, min_length)
+            tracksProcessor.tracks = Tracks(
+                {
+                    track_length: tracks
+                    for track_length, tracks in all_tracks.items()
+                    if track_length >= min_length
+                },
+                all_tracks.cells,
+            )
+
+            tracksEval = TracksEvaluator(truth, tracksProcessor)
+            tracksEval.evaluate()
+
+            point = (event_id, cell_angle, neigh_angle, min_length)
+            for stage, evaluator in [
+                ("cells", cellsEval),
+                ("neighbours", neighsEval),
+                ("tracks", tracksEval),
+            ]:
+                performance = evaluator.performance
+                rows.append(
+                    point
+                    + (stage, performance["efficiency"], performance["purity"])
+                )
+
+    return rows
@@ -1,17 +1,56 @@
-import copy
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
+from CCA.data.custom_tools import cell_angles, expand_ranges
 from CCA.data.tracks import Tracks
 
 
 class TracksProcessor:
-    def __init__(self, evolutionProcessor, min_length):
+    # With several workers, connected components of fewer cells are processed together
+    # in the main process rather than sent to a worker process each
+    min_part_cells = 10000
+
+    def __init__(self, evolutionProcessor, min_length, n_workers=1):
         """
         - min_length: minimum track length generated
+        - n_workers: number of processes generating the track candidates of the connected
+        components of the CA in parallel (see generate_parts)
         """
-        self.CA = evolutionProcessor.CA
-        self.cells = evolutionProcessor.cells
+        self.set_CA(
+            evolutionProcessor.CA,
+            evolutionProcessor.cells,
+            evolutionProcessor.cells_positions,
+        )
         self.min_length = min_length
+        self.n_workers = n_workers
+
+    @classmethod
+    def from_CA(cls, CA, min_length, n_workers=1):
+        """
+        Creates the processor of an evolved CA only, without an EvolutionProcessor
+        (e.g. for a part of a CA in a worker process). The cells and their positions
+        being unknown, the tracks can't then be turned into hits nor scored.
+        """
+        tracksProcessor = cls.__new__(cls)
+        tracksProcessor.set_CA(CA)
+        tracksProcessor.min_length = min_length
+        tracksProcessor.n_workers = n_workers
+
+        return tracksProcessor
+
+    def set_CA(self, CA, cells=None, cells_positions=None):
+        """
+        Sets the evolved CA to generate tracks from (and the cells and their positions,
+        unknown if None)
+        """
+        self.CA = CA
+        self.cells = cells
+        self.cells_positions = cells_positions
+
+        # Number of candidates generated and kept (after resolve_ambiguities) per track length,
+        # of shape {track_length: (generated, kept)}
+        self.candidate_counts = {}
 
     #     @property
     #     def tracks_as_hits(self)
@@ -20,7 +59,13 @@ class TracksProcessor:
 
     #         return tracks.to_hits(self.cells)
 
-    def generate(self, final_print=True, progress_print=False):
+    def generate(
+        self,
+        final_print=True,
+        progress_print=False,
+        max_paths_per_seed=None,
+        resolve=False,
+    ):
         """
         Generates an array of all track candidates from CA
 
@@ -30,75 +75,348 @@ class TracksProcessor:
         }
 
         This shape was chosen so that each value of the dict can be a Numpy array for fast processing
+
+        - max_paths_per_seed: None | int, if int, at most this many candidates are kept for each
+        seed cell (the first ones in the order of the inner neighbours). Bounds the time and memory
+        spent in dense regions, where the number of paths grows exponentially with their length.
+        - resolve: if True, overlapping candidates are then resolved (see resolve_ambiguities)
         """
         print("Generating track candidates...")
 
-        # Copying for modifying without modyfing orignal CA
-        CA = copy.deepcopy(self.CA)
-
-        max_length = max(CA.states)
+        max_length = self.CA.states[self.CA.alive].max() if len(self.CA) > 0 else 0
         track_lengths = np.arange(self.min_length, max_length + 1)
 
+        if self.n_workers > 1:
+            all_track_candidates = self.generate_parts(
+                track_lengths, max_paths_per_seed
+            )
+        else:
+            # Copying for modifying without modyfing orignal CA
+            # (only the states and alive mask are copied, the edge arrays are shared)
+            all_track_candidates = self.generate_candidates(
+                self.CA.copy(), track_lengths, max_paths_per_seed, progress_print
+            )
+
+        self.tracks = Tracks(all_track_candidates, self.cells)
+        self.candidate_counts = {
+            int(track_length): (tracks.shape[0], tracks.shape[0])
+            for track_length, tracks in all_track_candidates.items()
+        }
+
+        if final_print:
+            print(f"{self.tracks.size} tracks generated.")
+
+        if resolve:
+            self.resolve_ambiguities(final_print=final_print)
+
+    def resolve_ambiguities(self, max_shared_hits=0, final_print=True):
+        """
+        Keeps the best set of track candidates that don't overlap, in place of self.tracks.
+
+        Candidates are ranked by decreasing length, then by increasing score (see score_tracks).
+        Going through them in that order, a candidate is kept unless more than max_shared_hits
+        of its hits belong to already kept candidates. The candidates none of whose hits is in
+        another candidate (found with a count of the candidates of each hit) are kept without
+        being looked at in that greedy pass.
+        """
+        if self.tracks.size == 0:
+            if final_print:
+                print("0 overlapping tracks removed, 0 kept.")
+            return
+
+        track_lengths = sorted(self.tracks.keys(), reverse=True)
+        candidates = [self.tracks[track_length] for track_length in track_lengths]
+
+        # Hits of each candidate, flattened, and the candidate they belong to
+        tracks_as_hits = self.tracks.to_hits(sort_hits=False)
+        candidate_hits = [
+            tracks_as_hits.get(track_length + 1, np.empty((0, track_length + 1)))
+            for track_length in track_lengths
+        ]
+        n_candidates = np.array([tracks.shape[0] for tracks in candidates])
+        hits = np.concatenate([hits.ravel() for hits in candidate_hits]).astype(
+            np.int64
+        )
+        hit_owners = np.repeat(
+            np.arange(n_candidates.sum()),
+            np.repeat([length + 1 for length in track_lengths], n_candidates),
+        )
+
+        # Rank: longest first, then best score (lexsort sorts by its last key first)
+        lengths = np.repeat(track_lengths, n_candidates)
+        scores = np.concatenate(
+            [self.score_tracks(tracks) for tracks in candidates] + [[]]
+        )
+        ranking = np.lexsort((scores, -lengths))
+
+        # Candidates sharing at least one hit with another candidate
+        _, hit_indices, hit_counts = np.unique(
+            hits, return_inverse=True, return_counts=True
+        )
+        is_shared = np.zeros(n_candidates.sum(), dtype=bool)
+        is_shared[hit_owners[hit_counts[hit_indices] > 1]] = True
+
+        is_kept = ~is_shared
+        is_used = np.zeros(hit_counts.shape[0], dtype=bool)
+        is_used[hit_indices[~is_shared[hit_owners]]] = True
+
+        hit_indptr = np.concatenate(([0], np.cumsum(np.bincount(hit_owners))))
+        for candidate in ranking[is_shared[ranking]]:
+            own_hits = hit_indices[hit_indptr[candidate] : hit_indptr[candidate + 1]]
+
+            if np.count_nonzero(is_used[own_hits]) <= max_shared_hits:
+                is_kept[candidate] = True
+                is_used[own_hits] = True
+
+        # Back to a dict, keeping the order of the candidates of each length
+        bounds = np.concatenate(([0], np.cumsum(n_candidates)))
+        all_track_candidates = {
+            track_length: tracks[is_kept[bounds[i] : bounds[i + 1]]]
+            for i, (track_length, tracks) in enumerate(zip(track_lengths, candidates))
+        }
+
+        n_removed = self.tracks.size - int(np.count_nonzero(is_kept))
+        self.tracks = Tracks(all_track_candidates, self.cells)
+
+        for track_length, tracks in all_track_candidates.items():
+            track_length = int(track_length)
+            generated, _ = self.candidate_counts.get(track_length, (tracks.shape[0], 0))
+            self.candidate_counts[track_length] = (generated, tracks.shape[0])
+
+        if final_print:
+            print(f"{n_removed} overlapping tracks removed, {self.tracks.size} kept.")
+
+    def score_tracks(self, tracks):
+        """
+        Scores track candidates (the lower the straighter): the sum of the angles between
+        consecutive cells, as tested by NeighboursProcessor.check_angles.
+
+        - tracks: array of shape (track, cell) of cell_ids
+
+        returns a 1D array of dimensionality (track)
+        """
+        if tracks.shape[0] == 0 or tracks.shape[1] < 2:
+            return np.zeros(tracks.shape[0])
+
+        #    dimensionality: (track * consecutive pair, cell (in pair))
+        cell_pairs = np.stack((tracks[:, :-1], tracks[:, 1:]), axis=2).reshape(-1, 2)
+        angles = cell_angles(cell_pairs, self.cells_positions)
+
+        return angles.reshape(tracks.shape[0], -1).sum(axis=1)
+
+    def generate_candidates(
+        self, CA, track_lengths, max_paths_per_seed=None, progress_print=False
+    ):
+        """
+        Generates the track candidates of CA, whose cells are removed along the way,
+        for the given track lengths, starting from the longest.
+
+        returns a dictionary of shape:
+        {
+            [track_length]: Numpy array of cell_ids
+        }
+        """
+        is_complete = self.complete_cells(CA)
+
         # Looping through track lengths starting from longest
         all_track_candidates = {}
         for track_length in reversed(track_lengths):
-            track_candidates = []
-
             if progress_print:
                 print(f"Processing tracks of length {track_length}...", end="\r")
 
-            all_cell_indices = np.array(list(CA.keys()))
-            all_states = np.array([CA[i]["state"] for i in all_cell_indices])
+            track_candidates = self.extract_paths(
+                CA, track_length, max_paths_per_seed, is_complete
+            )
+            all_track_candidates[track_length] = track_candidates
 
-            indices = np.argwhere(all_states == track_length)[:, 0]
-            state_cell_indices = all_cell_indices[indices]
+            # Remove cells in track_candidates from CA graph
+            self.remove_cells(CA, np.unique(track_candidates), is_complete)
 
-            # Looping through cells of state = track_length
-            for j in range(len(state_cell_indices)):
-                cell_index = state_cell_indices[j]
-                cell = CA[cell_index]
+        return all_track_candidates
 
-                # Tree recursion through inner neighbours
-                self.tree_recursion_neighs(cell_index, CA, [], track_candidates)
+    def generate_parts(self, track_lengths, max_paths_per_seed=None):
+        """
+        Generates the track candidates of each connected component of the CA on its own,
+        since a track candidate never spans two components. The parts
+        (see CellularAutomaton.partition) of at least min_part_cells cells are processed in
+        parallel by a pool of n_workers processes, while the smaller components, batched
+        together, are processed at once in the main process. Without such large parts, the
+        whole CA is processed at once in the main process (see generate_candidates).
 
-            # Removing side-product candidates smaller than track_length
-            for i in reversed(range(len(track_candidates))):
-                if len(track_candidates[i]) < track_length:
-                    track_candidates.pop(i)
+        The candidates are merged in the same order as when generated on the whole CA
+        (by seed cell, in the order of the depth-first search from each seed).
 
-            track_candidates = np.array(track_candidates)
-            all_track_candidates[track_length] = track_candidates
+        returns a dictionary of shape:
+        {
+            [track_length]: Numpy array of cell_ids
+        }
+        """
+        parts = self.CA.partition(self.min_part_cells)
+        large_parts = [
+            cells for cells in parts if cells.shape[0] >= self.min_part_cells
+        ]
+        small_parts = [cells for cells in parts if cells.shape[0] < self.min_part_cells]
 
-            # Remove cells in track_candidates from CA graph
-            CA.remove_cells(np.unique(track_candidates.flatten()))
+        def part_args(cells):
+            return self.CA.subgraph(cells), track_lengths, max_paths_per_seed
 
-        self.tracks = Tracks(all_track_candidates, self.cells)
+        # Nothing to parallelize: processing the whole CA at once
+        if not large_parts:
+            return self.generate_candidates(
+                self.CA.copy(), track_lengths, max_paths_per_seed
+            )
 
-        if final_print:
-            print(f"{self.tracks.size} tracks generated.")
+        with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = [
+                executor.submit(_generate_part, *part_args(cells))
+                for cells in large_parts
+            ]
+            small_results = [
+                _generate_part(*part_args(cells)) for cells in small_parts
+            ]
+            results = [future.result() for future in futures] + small_results
+
+        all_track_candidates = {}
+        for track_length in reversed(track_lengths):
+            # Back to the cell_ids of the CA
+            track_candidates = np.concatenate(
+                [
+                    cells[part_candidates[track_length]]
+                    for cells, part_candidates in zip(
+                        large_parts + small_parts, results
+                    )
+                ]
+                + [np.empty((0, track_length), dtype=np.int64)]
+            )
+
+            order = np.argsort(track_candidates[:, 0], kind="stable")
+            all_track_candidates[track_length] = track_candidates[order]
 
-    def tree_recursion_neighs(self, cell_index, CA, chain, chains):
+        return all_track_candidates
+
+    def complete_cells(self, CA):
+        """
+        Returns the boolean mask of the "complete" cells: the alive cells from which a chain
+        of alive cells, each an inner neighbour of the previous one of state - 1, goes down
+        to a cell of state 1. Only complete cells can be part of a track candidate.
+
+        The states are gone through in increasing order, each cell's edges being visited once.
         """
-        Recursive function to generate the track candidates for a given (largest state) cell as the seed. 
+        is_complete = np.zeros(CA.n_cells, dtype=bool)
+        is_complete[CA.cells_with_state(1)] = True
 
-        The stop condition of my recursion is when the current cell doesn't have any more inner neighbours. 
+        for state in range(2, CA.state_indptr.shape[0] - 1):
+            cells = CA.cells_with_state(state)
+            owners, edge_indices = expand_ranges(
+                CA.indptr[cells], CA.indptr[cells + 1]
+            )
+            neighs = CA.indices[edge_indices]
 
-        Into the recursion function should be passed the current cell, its id, and an array of its parent cell indices, that is, the previous elements in the track candidate constructed so far.
+            is_step = is_complete[neighs] & (CA.states[neighs] == state - 1)
+            is_complete[cells[owners[is_step]]] = True
 
-        If the recursion needs to stop, then the current cell_index is just added to the chain and the chain is returned, 
-        If it needs to continue, then we loop over the inner neighbours and call the recursive function 
-        for each inner neighbour, and append the result of the recursion to the track candidate.
+        return is_complete
+
+    def remove_cells(self, CA, r_cells, is_complete):
         """
-        cell = CA[
-            cell_index
-        ]  # not using self.CA because CA in self.generate() is not the same as self.CA
-        chain.append(cell_index)
+        Removes cells from CA and updates is_complete (see complete_cells) accordingly.
 
-        if len(cell["inner_neighs"]) < 1:
-            chains.append(chain)
+        A cell becomes incomplete when it loses its last complete inner neighbour of
+        state - 1, so only the outer neighbours of the cells that became incomplete are
+        checked (through the reverse index of CA): the cost is proportional to the degree
+        of the cells affected, not to the size of the CA.
+        """
+        CA.remove_cells(r_cells)
+        is_complete[r_cells] = False
 
-        else:
-            for neigh_index in cell["inner_neighs"]:
-                new_chain = chain.copy()
-                self.tree_recursion_neighs(neigh_index, CA, new_chain, chains)
+        lost = np.asarray(r_cells, dtype=np.int64)
+        while lost.shape[0] > 0:
+            _, reverse_indices = expand_ranges(
+                CA.outer_indptr[lost], CA.outer_indptr[lost + 1]
+            )
+            parents = CA.outer_indices[reverse_indices]
+            parents = np.unique(parents[is_complete[parents]])
+
+            # Parents that still have a complete inner neighbour of state - 1
+            owners, edge_indices = expand_ranges(
+                CA.indptr[parents], CA.indptr[parents + 1]
+            )
+            neighs = CA.indices[edge_indices]
+            is_step = is_complete[neighs] & (
+                CA.states[neighs] == CA.states[parents[owners]] - 1
+            )
+            still_complete = np.zeros(parents.shape[0], dtype=bool)
+            still_complete[owners[is_step]] = True
+
+            lost = parents[~still_complete]
+            is_complete[lost] = False
+
+    def extract_paths(
+        self, CA, track_length, max_paths_per_seed=None, is_complete=None
+    ):
+        """
+        Returns the track candidates of length track_length, as a Numpy array of
+        shape (candidate, track_length) of cell_ids ordered from the outermost cell.
+
+        A candidate is a chain of alive cells, each an inner neighbour of the previous one,
+        from a seed of state track_length down to a cell of state 1. Since the state of a cell
+        is 1 + the length of the longest chain of its inner neighbours, along such a chain the
+        states decrease by exactly 1 at each step: only those inner neighbours are followed,
+        and only when they are complete (see complete_cells), so every path is extended
+        to full length.
+
+        The chains are grown one step at a time for all the seeds at once, keeping the order
+        of a depth-first search through the inner neighbours. Only the edges of the chains'
+        last cells are visited.
+
+        - is_complete: mask given by complete_cells(CA), computed if None
+        """
+        if is_complete is None:
+            is_complete = self.complete_cells(CA)
+
+        seeds = CA.cells_with_state(track_length)
+        seeds = seeds[is_complete[seeds]]
+        paths = seeds[:, np.newaxis].astype(np.int64)
+        path_seeds = np.arange(seeds.shape[0])
+
+        for _ in range(track_length - 1):
+            tails = paths[:, -1]
+            owners, edge_indices = expand_ranges(
+                CA.indptr[tails], CA.indptr[tails + 1]
+            )
+            neighs = CA.indices[edge_indices]
+
+            is_step = is_complete[neighs] & (
+                CA.states[neighs] == CA.states[tails[owners]] - 1
+            )
+            owners, neighs = owners[is_step], neighs[is_step]
+
+            paths = np.hstack((paths[owners], neighs[:, np.newaxis]))
+            path_seeds = path_seeds[owners]
+
+            if max_paths_per_seed is not None:
+                # Rank of each path among the paths of its seed (they are contiguous)
+                is_first = np.ones(path_seeds.shape[0], dtype=bool)
+                is_first[1:] = path_seeds[1:] != path_seeds[:-1]
+                first_indices = np.flatnonzero(is_first)
+                group_sizes = np.diff(np.append(first_indices, path_seeds.shape[0]))
+                ranks = np.arange(path_seeds.shape[0]) - np.repeat(
+                    first_indices, group_sizes
+                )
+
+                # Every kept path can be completed, so the first candidates of each seed
+                # are extensions of its first max_paths_per_seed paths
+                is_kept = ranks < max_paths_per_seed
+                paths, path_seeds = paths[is_kept], path_seeds[is_kept]
+
+        return paths
+
+
+def _generate_part(CA, track_lengths, max_paths_per_seed):
+    """
+    Generates the track candidates of a part of a CA (see TracksProcessor.generate_parts),
+    in a worker process
+    """
+    tracksProcessor = TracksProcessor.from_CA(CA, 0)
 
+    return tracksProcessor.generate_candidates(CA, track_lengths, max_paths_per_seed)
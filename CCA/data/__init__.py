@@ -11,7 +11,9 @@
 from .cellular_automaton import CellularAutomaton
 from .data_processor import DataProcessor
 from .event import Event
+from .event_store import EventStore
 from .hits import Hits
-from .tracks import Tracks
+from .stage_cache import StageCache
+from .tracks import Tracks, load_tracks, save_tracks
 from .truth import Truth
 
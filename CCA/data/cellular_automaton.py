@@ -1,59 +1,338 @@
+from collections.abc import Mapping
+
 import numpy as np
 
-class CellularAutomaton(dict):
+from .custom_tools import expand_ranges
+
+
+class CellularAutomaton(Mapping):
     """
     Class specifically for this tracking algorithm (not a general CA class)
-    
-    Inherits from dict, such that self gives the CA.
-    
-    The CA is a dict of shape
+
+    The CA is held in compressed sparse row (CSR) arrays:
+    - indptr: int32 array of shape (n_cells + 1,). The inner neighbours of cell c
+        are indices[indptr[c] : indptr[c + 1]]
+    - indices: int32 array of the inner neighbours' cell ids
+    - states: int16 array of the states of the cells
+    - alive: boolean mask of the cells that are part of the CA (see remove_cells)
+
+    Two indices are built on first use:
+    - outer_indptr, outer_indices: the reverse CSR arrays, of the outer neighbours of each cell
+        (shared by the copies of the CA, as the edges are)
+    - state_indptr, state_cells: the cell ids ordered by state. The cells of state s are
+        state_cells[state_indptr[s] : state_indptr[s + 1]]. States must therefore not be
+        modified in place once it is built (with_states gives a CA with other states)
+
+    Cell ids are the indices of the cells in the "cells" array.
+
+    It is also a read-only mapping (over the alive cells) of shape
     {
         [cell_id]: {
             "state": positive int
             "inner_neighs": array of cell_ids
         }
     }
-    """    
-    def __init__(self, CA):
-        super().__init__(CA)
-    
+    """
+
+    def __init__(self, indptr, indices, states=None, alive=None):
+        self._outer_index = None
+        self._state_index = None
+
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+
+        n_cells = self.indptr.shape[0] - 1
+
+        self.states = (
+            np.ones(n_cells, dtype=np.int16)
+            if states is None
+            else np.asarray(states, dtype=np.int16)
+        )
+        self.alive = (
+            np.ones(n_cells, dtype=bool)
+            if alive is None
+            else np.asarray(alive, dtype=bool)
+        )
+
+    @classmethod
+    def from_edges(cls, n_cells, outer, inner, states=None):
+        """
+        Creates the CA of n_cells cells from its edges, where inner[i] is an inner neighbour
+        of outer[i] (in the order of edges, so that from_edges(n_cells, *CA.edges()) gives
+        the CA back). The inner neighbours of a cell keep the order in which they are given.
+        """
+        inner = np.asarray(inner, dtype=np.int64)
+        outer = np.asarray(outer, dtype=np.int64)
+        assert inner.shape[0] < np.iinfo(np.int32).max
+
+        order = np.argsort(outer, kind="stable")
+        counts = np.bincount(outer, minlength=n_cells)
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+
+        return cls(indptr, inner[order], states)
+
+    @classmethod
+    def from_dict(cls, CA):
+        """
+        Creates the CA from a dict of shape {cell_id: {"state": int, "inner_neighs": [cell_ids]}}
+        whose cell ids are 0, ..., n_cells - 1 (cells missing from the dict are not alive)
+        """
+        n_cells = max(CA.keys()) + 1 if len(CA) > 0 else 0
+
+        cell_ids = np.array(sorted(CA.keys()), dtype=np.int64)
+        counts = np.zeros(n_cells, dtype=np.int64)
+        counts[cell_ids] = [len(CA[cell_id]["inner_neighs"]) for cell_id in cell_ids]
+
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        indices = [
+            neigh for cell_id in cell_ids for neigh in CA[cell_id]["inner_neighs"]
+        ]
+
+        states = np.ones(n_cells, dtype=np.int16)
+        states[cell_ids] = [CA[cell_id]["state"] for cell_id in cell_ids]
+
+        alive = np.zeros(n_cells, dtype=bool)
+        alive[cell_ids] = True
+
+        return cls(indptr, indices, states, alive)
+
+    def __getitem__(self, cell_id):
+        if not (0 <= cell_id < self.n_cells and self.alive[cell_id]):
+            raise KeyError(cell_id)
+
+        return {
+            "state": int(self.states[cell_id]),
+            "inner_neighs": self.inner_neighs(cell_id),
+        }
+
+    def __iter__(self):
+        return iter(self.cell_ids.tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
+
+    @property
+    def n_cells(self):
+        """
+        Number of cells, alive or not
+        """
+        return self.indptr.shape[0] - 1
+
     @property
-    def states(self):
+    def cell_ids(self):
         """
-        Returns a Numpy array of all the states of the CA
+        Numpy array of the ids of the alive cells
+        """
+        return np.flatnonzero(self.alive)
+
+    @property
+    def outer_indptr(self):
+        return self.outer_index()[0]
+
+    @property
+    def outer_indices(self):
+        return self.outer_index()[1]
+
+    @property
+    def state_indptr(self):
+        return self.state_index()[0]
+
+    @property
+    def state_cells(self):
+        return self.state_index()[1]
+
+    def outer_index(self):
+        """
+        Returns the (outer_indptr, outer_indices) reverse CSR arrays, building them if needed
+        """
+        if self._outer_index is None:
+            outer = np.repeat(
+                np.arange(self.n_cells, dtype=np.int32), np.diff(self.indptr)
+            )
+            order = np.argsort(self.indices, kind="stable")
+            counts = np.bincount(self.indices, minlength=self.n_cells)
+            outer_indptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int32)
+
+            self._outer_index = (outer_indptr, outer[order])
+
+        return self._outer_index
+
+    def state_index(self):
+        """
+        Returns the (state_indptr, state_cells) arrays, building them if needed
+        """
+        if self._state_index is None:
+            state_cells = np.argsort(self.states, kind="stable").astype(np.int32)
+            max_state = int(self.states.max()) if self.n_cells > 0 else 0
+            state_indptr = np.searchsorted(
+                self.states[state_cells], np.arange(max_state + 2)
+            )
+
+            self._state_index = (state_indptr, state_cells)
+
+        return self._state_index
+
+    def inner_neighs(self, cell_id):
         """
-        return np.array([val["state"] for val in self.values()])
-    
-    
+        Numpy array of the alive inner neighbours of a cell
+        """
+        neighs = self.indices[self.indptr[cell_id] : self.indptr[cell_id + 1]]
+
+        return neighs[self.alive[neighs]]
+
+    def outer_neighs(self, cell_id):
+        """
+        Numpy array of the alive outer neighbours of a cell
+        """
+        outer_indptr, outer_indices = self.outer_index()
+        neighs = outer_indices[outer_indptr[cell_id] : outer_indptr[cell_id + 1]]
+
+        return neighs[self.alive[neighs]]
+
+    def cells_with_state(self, state):
+        """
+        Numpy array of the alive cells of a given state
+        """
+        state_indptr, state_cells = self.state_index()
+        if not (0 <= state < state_indptr.shape[0] - 1):
+            return state_cells[:0]
+
+        cells = state_cells[state_indptr[state] : state_indptr[state + 1]]
+
+        return cells[self.alive[cells]]
+
+    def edges(self):
+        """
+        Returns (outer, inner) arrays of the edges between alive cells,
+        where inner[i] is an inner neighbour of outer[i]
+        """
+        outer = np.repeat(
+            np.arange(self.n_cells, dtype=np.int32), np.diff(self.indptr)
+        )
+        inner = self.indices
+
+        are_alive = self.alive[outer] & self.alive[inner]
+
+        return outer[are_alive], inner[are_alive]
+
+    def components(self):
+        """
+        Labels the connected components of the CA (ignoring the direction of the edges).
+
+        Returns an int32 array of the component of each cell, numbered from 0 in the order of
+        their smallest cell id, with -1 for the cells that are not alive.
+
+        Each cell takes the smallest label among itself and its neighbours until no label
+        changes, with pointer jumping (label of the label) to shortcut long chains.
+        """
+        outer, inner = self.edges()
+        labels = np.arange(self.n_cells, dtype=np.int64)
+
+        while True:
+            previous_labels = labels.copy()
+
+            edge_labels = np.minimum(labels[outer], labels[inner])
+            np.minimum.at(labels, outer, edge_labels)
+            np.minimum.at(labels, inner, edge_labels)
+            labels = labels[labels]
+
+            if np.array_equal(labels, previous_labels):
+                break
+
+        components = np.full(self.n_cells, -1, dtype=np.int32)
+        _, components[self.alive] = np.unique(labels[self.alive], return_inverse=True)
+
+        return components
+
+    def partition(self, min_part_cells=0):
+        """
+        Splits the alive cells into parts made of whole connected components (see components).
+
+        Each component of at least min_part_cells cells is a part on its own, and the smaller
+        ones are batched together into one last part (if any), so that they are all processed
+        at once by the vectorized kernels.
+
+        Returns a list of sorted arrays of cell_ids.
+        """
+        cell_ids = self.cell_ids
+
+        # No component can be large (and there is no need to label them)
+        if cell_ids.shape[0] < max(min_part_cells, 1):
+            return [cell_ids] if cell_ids.shape[0] > 0 else []
+
+        cell_components = self.components()[cell_ids]
+        component_sizes = np.bincount(cell_components)
+        is_large = component_sizes >= max(min_part_cells, 1)
+
+        # Cells of each large component, contiguous and sorted
+        is_batched = ~is_large[cell_components]
+        large_cells = cell_ids[~is_batched]
+        order = np.argsort(cell_components[~is_batched], kind="stable")
+        parts = np.split(large_cells[order], np.cumsum(component_sizes[is_large])[:-1])
+
+        if np.any(is_batched):
+            parts.append(cell_ids[is_batched])
+
+        return [cells for cells in parts if cells.shape[0] > 0]
+
+    def subgraph(self, cell_ids):
+        """
+        Returns the CA made of the given (sorted, alive) cells and of the edges between them.
+        Cell cell_ids[i] is cell i of the returned CA.
+        """
+        cell_ids = np.asarray(cell_ids, dtype=np.int64)
+
+        new_ids = np.full(self.n_cells, -1, dtype=np.int64)
+        new_ids[cell_ids] = np.arange(cell_ids.shape[0])
+
+        owners, edge_indices = expand_ranges(
+            self.indptr[cell_ids], self.indptr[cell_ids + 1]
+        )
+        inner = new_ids[self.indices[edge_indices]]
+        is_inside = inner >= 0
+
+        return CellularAutomaton.from_edges(
+            cell_ids.shape[0],
+            owners[is_inside],
+            inner[is_inside],
+            self.states[cell_ids],
+        )
+
     def states_dict(self):
         """
         Returns a dictionary of shape {cell_id: state}
         """
-        return {cell_id: cell["state"] for cell_id, cell in self.items()}
-    
-    def remove_cells(self, r_cells):
+        cell_ids = self.cell_ids
+
+        return dict(zip(cell_ids.tolist(), self.states[cell_ids].tolist()))
+
+    def with_states(self, states):
+        """
+        Returns a CA with the same cells and edges (shared, not copied) but the given states
         """
-        Removes cells by:
-        - deleting their entry (i.e. removing the vertices)
-        - Removing them from all inner_neighs arrays (i.e. removing the edges)
+        CA = CellularAutomaton(self.indptr, self.indices, states, self.alive.copy())
+        CA._outer_index = self._outer_index
 
-        r_cells: array of cells to remove
+        return CA
+
+    def copy(self):
+        """
+        Copy whose states and alive cells can be modified without modifying self
+        (the edge arrays, which are never modified, are shared)
         """
-        # creating a dict for speed
-        r_cells_dict = {cell_id: None for cell_id in r_cells}
-        
-        # Removing cells' entry
-        for cell_index in r_cells_dict.keys():
-            del self[cell_index]
+        CA = CellularAutomaton(
+            self.indptr, self.indices, self.states.copy(), self.alive.copy()
+        )
+        CA._outer_index = self._outer_index
 
-        # Removing cells in inner_neighs
-        for cell in self.values():
-            neighs = cell["inner_neighs"]
+        return CA
 
-            # Looping backwards to avoid change in indexing
-            for i in reversed(range(len(neighs))):
-                neigh_index = neighs[i]
+    def remove_cells(self, r_cells):
+        """
+        Removes cells by marking them as not alive. They then neither are
+        in the CA nor appear as inner (or outer) neighbours of other cells.
+        Costs O(len(r_cells)): the edge arrays are left untouched.
 
-                if neigh_index in r_cells_dict:
-                    del neighs[i]
-        
\ No newline at end of file
+        r_cells: array of cells to remove
+        """
+        self.alive[np.asarray(r_cells, dtype=np.int64)] = False
@@ -1,6 +1,8 @@
 import functools
 import warnings
 
+import numpy as np
+
 
 def ignore_warning(warning):
     """
@@ -24,3 +26,106 @@ def ignore_warning(warning):
         return wrapper
 
     return inner
+
+
+def split_blocks(sizes, max_size=None):
+    """
+    Splits consecutive items into blocks whose total size is at most max_size.
+
+    Args:
+        sizes (array): size of each item (e.g. bytes of temporaries needed to process it).
+        max_size (None | number): maximum total size of a block, unbounded if None.
+            An item larger than max_size makes a block on its own.
+
+    Returns:
+        list of (start, stop) such that items [start, stop) form a block.
+
+    """
+    n_items = len(sizes)
+
+    if max_size == None:
+        return [(0, n_items)] if n_items > 0 else []
+
+    cumulated_sizes = np.cumsum(sizes)
+
+    blocks = []
+    start = 0
+    while start < n_items:
+        size_before = cumulated_sizes[start - 1] if start > 0 else 0
+        stop = np.searchsorted(cumulated_sizes, size_before + max_size, side="right")
+        stop = max(int(stop), start + 1)
+
+        blocks.append((start, stop))
+        start = stop
+
+    return blocks
+
+
+def expand_ranges(starts, stops):
+    """
+    Expands integer ranges [starts[i], stops[i]) without looping over them.
+
+    Args:
+        starts (array): first integer of each range.
+        stops (array): end (excluded) of each range.
+
+    Returns:
+        (owners, values) where values are all the integers of the ranges, in order,
+        and owners the index i of the range each value comes from.
+
+    """
+    counts = np.maximum(stops - starts, 0)
+    owners = np.repeat(np.arange(starts.shape[0]), counts)
+    range_offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    values = starts[owners] + np.arange(owners.shape[0]) - range_offsets
+
+    return owners, values
+
+
+def cell_angles(cell_pairs, cells_positions):
+    """
+    Computes the angle between the two cells of each pair, i.e. between their vectors
+    going from their inner to their outer hit.
+
+    Args:
+        cell_pairs (array): dimensionality (pair, cell index).
+        cells_positions (array): dimensionality (cell, hit, hit_position_coordinate).
+
+    Returns:
+        1D array of the angles (rad), of dimensionality (pair).
+
+    """
+    #    dimensionality: (pair, cell (in pair), hit (in cell), position coordinate (of hit))
+    positions = cells_positions[cell_pairs]
+
+    # Computing vectors going from inner to outer hit for each cell
+    #    dimensionality: (pair, cell (in pair), position coordinate (of vector))
+    vec_diffs = positions[:, :, 1, :] - positions[:, :, 0, :]
+
+    # Computing the magnitude of all vector differences
+    #    dimensionality: (pair, cell (in pair))
+    mags = np.linalg.norm(vec_diffs, axis=2)
+
+    #    dimensionality: (pair)
+    dot_prods = np.sum(vec_diffs[:, 0] * vec_diffs[:, 1], axis=1)
+
+    return np.arccos(dot_prods / (mags[:, 0] * mags[:, 1]))
+
+
+def row_keys(rows):
+    """
+    Turns each row of a 2D integer array into a single key, to compare, sort or hash rows.
+
+    Args:
+        rows (array): dimensionality (row, column).
+
+    Returns:
+        1D array of dimensionality (row), whose items are the bytes of each row
+        (equal for rows with equal values).
+
+    """
+    rows = np.ascontiguousarray(rows, dtype=np.int64)
+
+    return rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).reshape(
+        -1
+    )
@@ -1,7 +1,11 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
 
 from .event import Event
+from .event_store import EventStore
 from .truth import Truth
 from .hits import Hits
 
@@ -13,27 +17,153 @@ class DataProcessor:
 
     default_path_to_base = "/Users/archibaldruban/Google Drive/1. Education/UCL/1. MSci Theoretical Physics/_year 4/Master's Project/datasets/train_100_events"
 
-    def __init__(self, path_to_base=None):
-        self.raw_data = {}
+    # Columns (and the dtypes they are parsed as) that process() and the CCA algorithm read.
+    # The "cells" content isn't used at all.
+    columns_manifest = {
+        "hits": {
+            "hit_id": np.int64,
+            "x": np.float64,
+            "y": np.float64,
+            "z": np.float64,
+            "volume_id": np.int64,
+            "layer_id": np.int64,
+        },
+        "particles": {"particle_id": np.int64, "px": np.float64, "py": np.float64},
+        "truth": {"hit_id": np.int64, "particle_id": np.int64},
+    }
+
+    def __init__(
+        self,
+        path_to_base=None,
+        path_to_cache=None,
+        n_workers=1,
+        max_events=None,
+        max_bytes=None,
+    ):
+        """
+        - path_to_cache: directory of the binary event cache (see Event),
+        defaults to path_to_base + "/cache"
+        - n_workers: number of threads loading events in parallel
+        - max_events, max_bytes: None | int, bounds of self.raw_data (see EventStore).
+        Least recently used events beyond them are unloaded and transparently reloaded on access.
+        """
+        self.n_workers = n_workers
+        self.raw_data = EventStore(max_events, max_bytes)
 
         if path_to_base == None:
             self.path_to_base = self.default_path_to_base
         else:
             self.path_to_base = path_to_base
 
-    def load(self, event_ids, content_to_load="all"):
+        self.path_to_cache = path_to_cache
+
+    def load(self, event_ids, content_to_load="manifest", all_columns=False):
         """
         Loads the events provided into self.raw_data
         
-        content_to_load options: "all", cells", "hits", "particles", "truth"
+        - content_to_load options: "manifest" (the content of columns_manifest, i.e. all but cells),
+        "all", cells", "hits", "particles", "truth"
+        - all_columns: if False, only the columns of columns_manifest are read
+
+        At most n_workers events are being loaded at once besides the ones in self.raw_data,
+        and with max_events, only the last max_events events are loaded: the other ones
+        would be unloaded right away, so they are only registered (loaded on access).
         """
-        for event_id in event_ids:
-            # Loading content for event
-            event = Event(event_id, self.path_to_base)
-            event.load_content(content_to_load)
+        event_ids = list(event_ids)
+        max_events = self.raw_data.max_events
+        n_lazy = 0 if max_events == None else max(len(event_ids) - max_events, 0)
+
+        for event_id in event_ids[:n_lazy]:
+            event = self.read_event(event_id, content_to_load, all_columns, lazy=True)
+            self.raw_data.set_unloaded(event_id, event)
+
+        def load_event(event_id):
+            return self.read_event(event_id, content_to_load, all_columns)
+
+        # Loading content for events (pd.read_csv and np.load release the GIL,
+        # so threads load in parallel), with at most n_workers events in flight
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            for event_id in event_ids[n_lazy:]:
+                pending.append((event_id, executor.submit(load_event, event_id)))
+
+                if len(pending) >= self.n_workers:
+                    event_id, future = pending.popleft()
+                    self.raw_data[event_id] = future.result()
+
+            while pending:
+                event_id, future = pending.popleft()
+                self.raw_data[event_id] = future.result()
+
+    def read_event(
+        self, event_id, content_to_load="manifest", all_columns=False, lazy=False
+    ):
+        """
+        Returns the Event with its content loaded, without storing it in self.raw_data
+
+        content_to_load, all_columns: see load
+        lazy: if True, the content isn't loaded yet, but will be by Event.reload
+        """
+        if content_to_load == "manifest":
+            content_to_load = list(self.columns_manifest.keys())
+
+        columns = None if all_columns else self.columns_manifest
+
+        event = Event(event_id, self.path_to_base, self.path_to_cache)
+        if lazy:
+            event.load_args = (content_to_load, columns)
+        else:
+            event.load_content(content_to_load, columns)
+
+        return event
+
+    def iter_processed(self, event_ids, prefetch=2, **process_kwargs):
+        """
+        Generator yielding (event_id, Hits, Truth) for the events provided, in order.
+
+        The next "prefetch" events are loaded and processed on background threads
+        while the caller works on the current one (e.g. runs CCAProcessor on it).
+        Events are read directly rather than through self.raw_data, so at most
+        prefetch + 1 events are held in memory whatever the number of events.
+
+        - prefetch: number of events loaded and processed ahead (0 for no prefetching)
+        - process_kwargs: passed to process_event (pT_min, n_particles, ...).
+        Note that with prefetch > 0, random particle selection (n_particles) happens
+        in background threads, so np.random.seed doesn't make it reproducible.
+        """
+
+        def read_and_process(event_id):
+            return self.process_event(self.read_event(event_id), **process_kwargs)
 
-            # Saving event
-            self.raw_data[event_id] = event
+        event_ids = list(event_ids)
+        pending = deque()
+        n_submitted = 0
+
+        executor = ThreadPoolExecutor(max_workers=max(prefetch, 1))
+        try:
+            for event_id in event_ids:
+                # Keeping "prefetch" events in flight besides the current one
+                while len(pending) <= prefetch and n_submitted < len(event_ids):
+                    future = executor.submit(read_and_process, event_ids[n_submitted])
+                    pending.append(future)
+                    n_submitted += 1
+
+                hits, truth = pending.popleft().result()
+
+                yield event_id, hits, truth
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def build_cache(self, event_ids, content_to_cache="all"):
+        """
+        One-time conversion of the .csv files of the events provided into the binary
+        cache, from which subsequent loads are memory-mapped
+
+        content_to_cache options: "all", cells", "hits", "particles", "truth"
+        """
+        for event_id in event_ids:
+            event = Event(event_id, self.path_to_base, self.path_to_cache)
+            event.save_cache(content_to_cache)
 
     def delete(self, event_ids):
         """
@@ -42,14 +172,22 @@ class DataProcessor:
         event_ids: "all" | Array<event_id>
         """
         if event_ids == "all":
-            self.raw_data = {}
+            self.raw_data.clear()
         else:
             for event_id in event_ids:
                 del self.raw_data[event_id]
 
-    def process(
+    def process(self, event_id, *args, **kwargs):
+        """
+        Returns a tuple (Hits, Truth) for an event of self.raw_data
+
+        Parameters: see process_event
+        """
+        return self.process_event(self.raw_data[event_id], *args, **kwargs)
+
+    def process_event(
         self,
-        event_id,
+        event,
         pT_min=False,
         n_particles="all",
         remove_layer_duplicates=True,
@@ -64,13 +202,12 @@ class DataProcessor:
         - Renaming layers as to make the volumes provided look like one big volume
         
         Parameters:
-        - event_id: str
+        - event: Event with its hits, particles and truth loaded
         - n_particles: "all" | int
         - pT_min: False | float - if float, applies cut by removing particles with pT < pT_min
         - volume_ids: array of volume_ids. Designed to work on adjacent barrel volumes 8, 13, 17
         but could work on similarly simply connected volumes.
         """
-        event = self.raw_data[event_id]
         df_particles = event.data["particles"]
         df_truth = event.data["truth"]
         df_hits = event.data["hits"]
@@ -83,34 +220,33 @@ class DataProcessor:
             df_particles = self.filter_randomly(df_particles, n_particles)
 
         # Collecting hits of corresponding particles in "truth"
-        keep_indices = df_truth["particle_id"].isin(df_particles["particle_id"])
-        df_truth = df_truth[keep_indices]
+        is_selected = df_truth["particle_id"].isin(df_particles["particle_id"])
+        is_selected = is_selected.to_numpy()
+        selected_hit_ids = pd.Index(df_truth["hit_id"].to_numpy()[is_selected])
+        selected_truth_rows = np.flatnonzero(is_selected)
 
-        # Collecting corresponding hits in "hits"
-        keep_indices = df_hits["hit_id"].isin(df_truth["hit_id"])
-        df_hits = df_hits[keep_indices]
+        # Joining "hits" onto those hits in a single index lookup
+        # (position of each hit in selected_hit_ids, -1 if it is not there)
+        hit_to_truth = selected_hit_ids.get_indexer(df_hits["hit_id"].to_numpy())
+        in_truth = hit_to_truth >= 0
 
         # Just a sanity / safety check that all the hits in the dataframes hits and truth are the same
         # It is to make sure that I am not filtering out any hits in truth when attempting to keep only
         # those in the relevant detector volumes (in the next line of code) (as df_truth doesn't have
         # any "volume_id" property)
-        all_truth_in_hits = (
-            df_truth[~df_truth["hit_id"].isin(df_hits["hit_id"])].shape[0] == 0
-        )
-        all_hits_in_truth = (
-            df_hits[~df_hits["hit_id"].isin(df_truth["hit_id"])].shape[0] == 0
-        )
-        assert all_truth_in_hits and all_hits_in_truth
+        assert np.count_nonzero(in_truth) == selected_hit_ids.shape[0]
 
         # Keeping only wanted detector volumes
-        df_hits = df_hits[df_hits["volume_id"].isin(volume_ids)]
-        df_truth = df_truth[df_truth["hit_id"].isin(df_hits["hit_id"])]
+        keep = in_truth & df_hits["volume_id"].isin(volume_ids).to_numpy()
+        df_truth = df_truth.iloc[np.sort(selected_truth_rows[hit_to_truth[keep]])]
+        df_hits = df_hits[keep].copy()
 
         # Transform the layer_ids to 100*volume_id + layer_id
-        for index, row in df_hits.iterrows():
-            df_hits.at[index, "layer_id"] = self.processed_layer_id(
-                row["volume_id"], row["layer_id"]
-            )
+        # (cast as compact cached ids, e.g. uint8, would overflow)
+        df_hits["layer_id"] = self.processed_layer_id(
+            df_hits["volume_id"].to_numpy(dtype=np.int64),
+            df_hits["layer_id"].to_numpy(dtype=np.int64),
+        )
 
         # REMOVING LAYER DUPLICATES MUST COME AFTER THE LAYER ID RENAMING
         if remove_layer_duplicates:
@@ -119,7 +255,10 @@ class DataProcessor:
         return Hits(df_hits), Truth(df_truth)
 
     def processed_layer_id(self, volume_id, layer_id):
-        return int(100 * volume_id + layer_id)
+        """
+        Works on single ids as well as on Numpy arrays of ids
+        """
+        return 100 * volume_id + layer_id
 
     def apply_pT_cut(self, df_particles, pT_min):
         """
@@ -150,21 +289,9 @@ class DataProcessor:
             right_index=True,
         )
 
-        particle_ids = df_merged["particle_id"].unique()
-        layer_ids = df_merged["layer_id"].unique()
-
-        drop_indices = []
-
-        for particle_id in particle_ids:
-            particle_hits = df_merged[df_merged["particle_id"] == particle_id]
-
-            for layer_id in layer_ids:
-                particle_layer_hits = particle_hits[
-                    particle_hits["layer_id"] == layer_id
-                ]
-
-                if particle_layer_hits.shape[0] > 1:
-                    drop_indices.extend(particle_layer_hits[1:].index)
+        # All but the first hit of each (particle, layer) group are duplicates
+        is_duplicate = df_merged.duplicated(["particle_id", "layer_id"], keep="first")
+        drop_indices = df_merged.index[is_duplicate]
 
         df_hits_filtered = df_hits.drop(drop_indices)
         df_truth_filtered = df_truth.drop(drop_indices)
@@ -1,35 +1,270 @@
+import os
+import shutil
+
+import numpy as np
 import pandas as pd
 
 
 class Event:
     """
     Class for a collision event from the TrackML dataset
+
+    Content is read from the event's .csv files or, if the event was converted
+    with save_cache, from memory-mapped binary column files with compact dtypes.
+    The cache has layout:
+        path_to_cache/[event_id]-[content_name]/[column].npy
+    The cache of a content is only used while it matches the .csv file it was converted
+    from (same modification time and size), the .csv file being read otherwise.
+
+    Cached columns have the compact dtypes of cache_dtypes: the coordinates, in particular,
+    are float32, so results computed from the cache can differ slightly from the ones
+    computed from the .csv files.
     """
 
     default_path_to_base = "/Users/archibaldruban/Google Drive/1. Education/UCL/1. BSc Theoretical Physics/_year 4/Master's Project/datasets/train_100_events"
 
-    def __init__(self, event_id, path_to_base=None):
+    # Dtypes of the columns in the binary cache.
+    # Integer columns whose values don't fit the given dtype keep their original dtype.
+    cache_dtypes = {
+        "cells": {
+            "hit_id": np.int32,
+            "ch0": np.int16,
+            "ch1": np.int16,
+            "value": np.float32,
+        },
+        "hits": {
+            "hit_id": np.int32,
+            "x": np.float32,
+            "y": np.float32,
+            "z": np.float32,
+            "volume_id": np.uint8,
+            "layer_id": np.uint8,
+            "module_id": np.int16,
+        },
+        "particles": {
+            "particle_id": np.int64,
+            "vx": np.float32,
+            "vy": np.float32,
+            "vz": np.float32,
+            "px": np.float32,
+            "py": np.float32,
+            "pz": np.float32,
+            "q": np.int8,
+            "nhits": np.int16,
+        },
+        "truth": {
+            "hit_id": np.int32,
+            "particle_id": np.int64,
+            "tx": np.float32,
+            "ty": np.float32,
+            "tz": np.float32,
+            "tpx": np.float32,
+            "tpy": np.float32,
+            "tpz": np.float32,
+            "weight": np.float32,
+        },
+    }
+
+    def __init__(self, event_id, path_to_base=None, path_to_cache=None):
         self.event_id = event_id
         self.data = {"cells": None, "hits": None, "particles": None, "truth": None}
 
         self.path_to_base = (
             path_to_base if path_to_base != None else self.default_path_to_base
         )
+        self.path_to_cache = (
+            path_to_cache if path_to_cache != None else self.path_to_base + "/cache"
+        )
 
-    def load_content(self, content_to_load):
+        # Arguments of the last call to load_content, None if the data was set directly
+        # (the event can then not be reloaded)
+        self.load_args = None
+
+    def load_content(self, content_to_load, columns=None):
         """
-        Loads the content of .csv file into self.data
+        Loads the content of .csv file (or of its binary cache) into self.data
 
-        content_to_load options: "all", cells", "hits", "particles", "truth"
+        - content_to_load options: "all", cells", "hits", "particles", "truth"
+        or a list of these
+        - columns: None | dict of shape {content_name: {column: dtype}}. If provided,
+        only the columns listed for a content are read (all of them if the content isn't listed)
         """
         if content_to_load == "all":
-            for key in self.data.keys():
-                path = self.get_path_to(key)
-                self.data[key] = pd.read_csv(path)
-
+            content_names = list(self.data.keys())
+        elif isinstance(content_to_load, str):
+            content_names = [content_to_load]
         else:
-            path = self.get_path_to(content_to_load)
-            self.data[key] = pd.read_csv(path)
+            content_names = content_to_load
+
+        for key in content_names:
+            content_columns = columns.get(key) if columns != None else None
+            self.data[key] = self.read(key, content_columns)
+
+        # Remembered for reload()
+        self.load_args = (content_to_load, columns)
+
+    def reload(self):
+        """
+        Loads the content again with the arguments of the last call to load_content
+        """
+        if not self.can_reload:
+            raise ValueError(
+                "Event {0} can't be reloaded (not loaded with load_content)".format(
+                    self.event_id
+                )
+            )
+
+        self.load_content(*self.load_args)
+
+    @property
+    def can_reload(self):
+        return self.load_args != None
+
+    def unload(self):
+        """
+        Frees the loaded content (the event can be loaded again with reload)
+        """
+        self.data = {key: None for key in self.data.keys()}
+
+    @property
+    def nbytes(self):
+        """
+        Total size in memory of the loaded content
+        """
+        return int(
+            sum(
+                df.memory_usage(index=True).sum()
+                for df in self.data.values()
+                if df is not None
+            )
+        )
+
+    def read(self, content_name, columns=None):
+        """
+        Returns the content as a dataframe, memory-mapped from the binary cache
+        if the event has been cached, parsed from the .csv file otherwise
+
+        columns: None | dict of shape {column: dtype}, the columns to read and the dtypes
+        to parse them as (cached columns keep their compact dtype)
+        """
+        if self.is_cached(content_name):
+            return self.read_cache(content_name, columns)
+
+        if columns == None:
+            return pd.read_csv(self.get_path_to(content_name))
+
+        return pd.read_csv(
+            self.get_path_to(content_name), usecols=list(columns), dtype=columns
+        )
+
+    def is_cached(self, content_name):
+        """
+        Whether the content has an up-to-date binary cache: converted from the current
+        .csv file (if the .csv file is still there)
+        """
+        path = self.get_path_to_cache(content_name)
+        if not os.path.isdir(path):
+            return False
+
+        if not os.path.isfile(self.get_path_to(content_name)):
+            return True
+
+        try:
+            with open(path + "/source.txt") as f:
+                return f.read().split() == self.source_stamp(content_name)
+        except FileNotFoundError:
+            return False
+
+    def source_stamp(self, content_name):
+        """
+        Modification time (ns) and size of the .csv file of the content, as strings,
+        identifying the version of the file a cache was converted from
+        """
+        stat = os.stat(self.get_path_to(content_name))
+
+        return [str(stat.st_mtime_ns), str(stat.st_size)]
+
+    def read_cache(self, content_name, columns=None):
+        """
+        Returns the cached content as a dataframe whose columns are read-only
+        memory maps of the .npy files (nothing is read until it is accessed)
+
+        columns: None | iterable of the columns to open (all of them if None)
+        """
+        path = self.get_path_to_cache(content_name)
+
+        with open(path + "/columns.txt") as f:
+            cached_columns = f.read().split()
+
+        if columns != None:
+            missing = set(columns).difference(cached_columns)
+            if missing:
+                raise KeyError(
+                    "Columns {0} are not in the cache of {1}".format(
+                        sorted(missing), self.get_path_to_cache(content_name)
+                    )
+                )
+            cached_columns = [c for c in cached_columns if c in columns]
+
+        data = {
+            column: np.load(path + "/" + column + ".npy", mmap_mode="r")
+            for column in cached_columns
+        }
+
+        return pd.DataFrame(data, copy=False)
+
+    def save_cache(self, content_to_save="all"):
+        """
+        Converts the .csv file of the content (once) into the binary cache, using self.cache_dtypes.
+        All columns are cached, whatever was loaded into self.data.
+
+        content_to_save options: "all", cells", "hits", "particles", "truth"
+        """
+        content_names = (
+            self.data.keys() if content_to_save == "all" else [content_to_save]
+        )
+
+        for content_name in content_names:
+            # Stamped before reading, so that a file modified meanwhile is seen as newer
+            source_stamp = self.source_stamp(content_name)
+            df = pd.read_csv(self.get_path_to(content_name))
+
+            dtypes = self.cache_dtypes.get(content_name, {})
+
+            # Writing to a temporary directory first so that an interrupted
+            # conversion never leaves a partial cache behind
+            path = self.get_path_to_cache(content_name)
+            tmp_path = path + ".tmp"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+
+            for column in df.columns:
+                values = self.compact(df[column].to_numpy(), dtypes.get(column))
+                np.save(tmp_path + "/" + column + ".npy", values)
+
+            with open(tmp_path + "/columns.txt", "w") as f:
+                f.write("\n".join(df.columns))
+
+            with open(tmp_path + "/source.txt", "w") as f:
+                f.write(" ".join(source_stamp))
+
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp_path, path)
+
+    @staticmethod
+    def compact(values, dtype):
+        """
+        Casts values to dtype, unless dtype is None or values are integers out of its range
+        """
+        if dtype == None:
+            return values
+
+        if np.issubdtype(dtype, np.integer) and values.shape[0] > 0:
+            info = np.iinfo(dtype)
+            if values.min() < info.min or values.max() > info.max:
+                return values
+
+        return values.astype(dtype)
 
     def get_path_to(self, content_name):
         """
@@ -42,3 +277,11 @@ class Event:
             return self.path_to_base
 
         return self.path_to_base + "/" + self.event_id + "-" + content_name + ".csv"
+
+    def get_path_to_cache(self, content_name):
+        """
+        Gives the path to the directory holding the binary column files of the content
+
+        content_name options: "cells", "hits", "particles", "truth"
+        """
+        return self.path_to_cache + "/" + self.event_id + "-" + content_name
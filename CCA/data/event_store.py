@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+
+class EventStore(MutableMapping):
+    """
+    Size-bounded mapping of shape {event_id: Event} for the loaded events.
+
+    At most max_events events and/or max_bytes bytes of event data are kept in memory.
+    When a bound is exceeded, the least recently used events are unloaded (their Event
+    object is kept, without its data). An unloaded event is reloaded, with the content
+    and columns it was first loaded with, the next time it is accessed.
+
+    The most recently used event is never unloaded, even if it exceeds max_bytes by itself,
+    and neither are the events that can't be reloaded (whose data was set directly
+    rather than loaded with Event.load_content).
+
+    Events can also be stored unloaded (see set_unloaded), to be loaded on first access.
+    """
+
+    def __init__(self, max_events=None, max_bytes=None):
+        """
+        max_events, max_bytes: None (unbounded) | int
+        """
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+
+        # Loaded events, from least to most recently used
+        self._loaded = OrderedDict()
+        self._nbytes = {}
+
+        # Unloaded events, reloaded on access
+        self._unloaded = {}
+
+    def __getitem__(self, event_id):
+        if event_id in self._unloaded:
+            event = self._unloaded.pop(event_id)
+            event.reload()
+            self._insert(event_id, event)
+
+        event = self._loaded[event_id]
+        self._loaded.move_to_end(event_id)
+
+        return event
+
+    def __setitem__(self, event_id, event):
+        self._unloaded.pop(event_id, None)
+        self._insert(event_id, event)
+
+    def set_unloaded(self, event_id, event):
+        """
+        Stores an event whose content isn't loaded yet (but can be, see Event.reload),
+        to be loaded the first time it is accessed
+        """
+        self._loaded.pop(event_id, None)
+        self._nbytes.pop(event_id, None)
+        self._unloaded[event_id] = event
+
+    def __delitem__(self, event_id):
+        if event_id in self._unloaded:
+            del self._unloaded[event_id]
+        else:
+            del self._loaded[event_id]
+            del self._nbytes[event_id]
+
+    def __iter__(self):
+        yield from list(self._loaded.keys()) + list(self._unloaded.keys())
+
+    def __len__(self):
+        return len(self._loaded) + len(self._unloaded)
+
+    def __contains__(self, event_id):
+        return event_id in self._loaded or event_id in self._unloaded
+
+    def clear(self):
+        self._loaded.clear()
+        self._nbytes.clear()
+        self._unloaded.clear()
+
+    @property
+    def loaded_ids(self):
+        """
+        Ids of the events currently held in memory, from least to most recently used
+        """
+        return list(self._loaded.keys())
+
+    @property
+    def nbytes(self):
+        """
+        Total size of the event data currently held in memory
+        """
+        return sum(self._nbytes.values())
+
+    def _insert(self, event_id, event):
+        self._loaded[event_id] = event
+        self._loaded.move_to_end(event_id)
+        self._nbytes[event_id] = event.nbytes
+
+        self._evict()
+
+    def _evict(self):
+        """
+        Unloads least recently used events until the bounds are satisfied
+        """
+        # Events that can be unloaded, from least to most recently used
+        candidates = [
+            event_id
+            for event_id, event in list(self._loaded.items())[:-1]
+            if event.can_reload
+        ]
+
+        for event_id in candidates:
+            if not self._is_over_bounds():
+                break
+
+            event = self._loaded.pop(event_id)
+            del self._nbytes[event_id]
+
+            event.unload()
+            self._unloaded[event_id] = event
+
+    def _is_over_bounds(self):
+        too_many = self.max_events != None and len(self._loaded) > self.max_events
+        too_big = self.max_bytes != None and self.nbytes > self.max_bytes
+
+        return too_many or too_big
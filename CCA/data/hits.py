@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 from CCA.data.custom_tools import ignore_warning
@@ -8,6 +9,7 @@ class Hits(pd.DataFrame):
     Extension of the hits dataframe from the dataset with all pandas.DataFrame properties and additionally:
     - layer_ids()
     - hit_ids()
+    - get_layer_index()
     """
 
     def __init__(self, *args, **kwargs):
@@ -31,10 +33,70 @@ class Hits(pd.DataFrame):
     @property
     def layer_ids(self):
         """
-        Numpy array of layer ids (w/o duplicates)
+        Sorted list of layer ids (w/o duplicates)
         """
-        if not hasattr(self, "_lids"):
-            self._lids = self["layer_id"].drop_duplicates().to_list()
+        return self.get_layer_index().layer_ids.tolist()
 
-        return self._lids
+    @ignore_warning(UserWarning)
+    def get_layer_index(self, sort_by_phi=False):
+        """
+        Returns the LayerIndex of the hits (computed once, then cached)
+        """
+        if not hasattr(self, "_lindex"):
+            self._lindex = {}
+
+        if sort_by_phi not in self._lindex:
+            self._lindex[sort_by_phi] = LayerIndex(self, sort_by_phi)
+
+        return self._lindex[sort_by_phi]
+
+
+class LayerIndex:
+    """
+    Hits stably sorted by layer (and optionally by phi within each layer), such that
+    the hits of a layer form a contiguous slice of the sorted arrays.
+
+    Properties:
+    - layer_ids: sorted Numpy array of the layer ids (w/o duplicates)
+    - offsets: the hits of layer_ids[i] are at [offsets[i], offsets[i + 1]) in the sorted arrays
+    - order: row positions in the Hits of the sorted hits
+    - hit_ids: sorted hit ids
+    - positions: sorted hit positions, shape (hit, coordinate (x, y, z))
+    """
+
+    def __init__(self, hits, sort_by_phi=False):
+        layer_ids = hits["layer_id"].to_numpy()
+        positions = hits[["x", "y", "z"]].to_numpy()
+
+        if sort_by_phi:
+            phi = np.arctan2(positions[:, 1], positions[:, 0])
+            order = np.lexsort((phi, layer_ids))
+        else:
+            order = np.argsort(layer_ids, kind="stable")
+
+        self.layer_ids, starts = np.unique(layer_ids[order], return_index=True)
+        self.offsets = np.append(starts, order.shape[0])
+
+        self.order = order
+        self.hit_ids = hits["hit_id"].to_numpy()[order]
+        self.positions = positions[order]
+
+        self._layer_positions = {
+            layer_id: i for i, layer_id in enumerate(self.layer_ids.tolist())
+        }
+
+    def layer_slice(self, layer_id):
+        """
+        Slice of the sorted arrays holding the hits of the layer
+        """
+        i = self._layer_positions[layer_id]
+
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def layer(self, layer_id):
+        """
+        Returns (hit_ids, positions) of the hits of the layer, as views of the sorted arrays
+        """
+        layer_slice = self.layer_slice(layer_id)
 
+        return self.hit_ids[layer_slice], self.positions[layer_slice]
@@ -0,0 +1,195 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class StageCache:
+    """
+    Content-addressed cache of the results of the stages of CCAProcessor.
+
+    A result is a dict of shape {name: Numpy array}, stored under a key that is a
+    fingerprint of the stage's inputs and parameters (see fingerprint). It is held in:
+    - memory: at most max_entries results and/or max_bytes bytes, the least recently used
+    results being evicted first (the most recently used is never evicted)
+    - optionally on disk, as path/[key].npz files: at most max_disk_bytes bytes, the least
+    recently used files being deleted first. A result found on disk is also put back in memory.
+
+    The arrays of the results are made read-only when stored, as they are shared by every
+    consumer of the cache (including the processor that computed them): a consumer that
+    needs to modify one must copy it.
+
+    stats gives the number of hits (in memory and on disk) and misses.
+    """
+
+    def __init__(
+        self, max_entries=None, max_bytes=None, path=None, max_disk_bytes=None
+    ):
+        """
+        max_entries, max_bytes, max_disk_bytes: None (unbounded) | int
+        path: None | directory of the on-disk layer (no on-disk layer if None)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+
+        # Results in memory, from least to most recently used
+        self._results = OrderedDict()
+        self._nbytes = {}
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if path != None:
+            os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(*parts):
+        """
+        Returns a key (hex string) identifying the given parts, which can be Numpy arrays
+        (identified by their dtype, shape and content) or any value with a stable repr
+        (e.g. other keys, stage names and parameters). Numpy scalars are identified as the
+        equal Python scalars (np.float64(0.4) as 0.4).
+        """
+        digest = hashlib.blake2b(digest_size=20)
+
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                array = np.ascontiguousarray(part)
+                digest.update(repr((array.dtype.str, array.shape)).encode())
+                digest.update(array.tobytes())
+            else:
+                if isinstance(part, np.generic):
+                    part = part.item()
+
+                digest.update(repr(part).encode())
+
+            # Separator, such that ("ab", "c") and ("a", "bc") differ
+            digest.update(b"\0")
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the result stored under key, or None if there is none
+        """
+        if key in self._results:
+            self._results.move_to_end(key)
+            self.hits += 1
+
+            return self._results[key]
+
+        file_path = self.file_path(key)
+        if file_path != None and os.path.isfile(file_path):
+            with np.load(file_path) as npz:
+                result = {name: npz[name] for name in npz.files}
+
+            # Marking the file as recently used
+            os.utime(file_path)
+
+            self._insert(key, result)
+            self.disk_hits += 1
+
+            return result
+
+        self.misses += 1
+
+        return None
+
+    def put(self, key, result):
+        """
+        Stores result (dict of shape {name: Numpy array}) under key
+        """
+        self._insert(key, result)
+
+        file_path = self.file_path(key)
+        if file_path != None:
+            # Writing to a temporary file first so that an interrupted
+            # write never leaves a partial result behind
+            tmp_path = file_path + ".tmp.npz"
+            np.savez(tmp_path, **result)
+            os.replace(tmp_path, file_path)
+
+            self._evict_disk()
+
+    def clear(self):
+        """
+        Empties the memory layer (the on-disk layer is kept)
+        """
+        self._results.clear()
+        self._nbytes.clear()
+
+    def file_path(self, key):
+        if self.path == None:
+            return None
+
+        return os.path.join(self.path, key + ".npz")
+
+    @property
+    def nbytes(self):
+        """
+        Total size of the results currently held in memory
+        """
+        return sum(self._nbytes.values())
+
+    @property
+    def stats(self):
+        """
+        Dict of shape {"hits", "disk_hits", "misses", "entries", "nbytes"}
+        """
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self._results),
+            "nbytes": self.nbytes,
+        }
+
+    def _insert(self, key, result):
+        for array in result.values():
+            array.setflags(write=False)
+
+        self._results[key] = result
+        self._results.move_to_end(key)
+        self._nbytes[key] = sum(array.nbytes for array in result.values())
+
+        self._evict()
+
+    def _evict(self):
+        """
+        Removes least recently used results from memory until the bounds are satisfied
+        """
+        while len(self._results) > 1 and self._is_over_bounds():
+            key, _ = self._results.popitem(last=False)
+            del self._nbytes[key]
+
+    def _is_over_bounds(self):
+        too_many = self.max_entries != None and len(self._results) > self.max_entries
+        too_big = self.max_bytes != None and self.nbytes > self.max_bytes
+
+        return too_many or too_big
+
+    def _evict_disk(self):
+        """
+        Deletes least recently used files until the on-disk layer fits max_disk_bytes
+        """
+        if self.max_disk_bytes == None:
+            return
+
+        files = [
+            os.path.join(self.path, name)
+            for name in os.listdir(self.path)
+            if name.endswith(".npz") and not name.endswith(".tmp.npz")
+        ]
+        files.sort(key=os.path.getmtime)
+
+        total_bytes = sum(os.path.getsize(file) for file in files)
+        for file in files[:-1]:
+            if total_bytes <= self.max_disk_bytes:
+                break
+
+            total_bytes -= os.path.getsize(file)
+            os.remove(file)
@@ -1,6 +1,9 @@
-from functools import reduce
+import os
+
 import numpy as np
 
+from CCA.data.custom_tools import expand_ranges
+
 
 class Tracks(dict):
     """
@@ -8,21 +11,156 @@ class Tracks(dict):
     {
         [track_length]: Numpy array of cell_ids
     }
-    
-    properties:
-    - changed: 
+
+    The tracks are stored as a ragged array, grouped by length:
+    - cell_ids: flat int32 array of the cell_ids of all tracks, one track after the other
+    - offsets: the cells of track i are cell_ids[offsets[i] : offsets[i + 1]]
+    The values of the dictionary are views of cell_ids, of shape (track, cell).
+
+    The hit ids of the tracks (see to_hits) are computed when first needed, in the
+    same ragged layout (hit_ids and hit_offsets), and shared by all the views returned.
+
+    Tracks can be saved and loaded for many events at once (see save_tracks and load_tracks).
     """
 
     def __init__(self, dict_, cells):
-        super().__init__(dict_)
+        track_lengths = sorted(dict_.keys(), reverse=True)
+        all_tracks = [np.asarray(dict_[length]) for length in track_lengths]
+
+        cell_ids = np.concatenate(
+            [tracks.reshape(-1) for tracks in all_tracks] + [np.empty(0)]
+        ).astype(np.int32)
+        lengths = np.repeat(
+            np.array(track_lengths, dtype=np.int64),
+            [tracks.shape[0] for tracks in all_tracks],
+        )
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+        self.set_ragged(cell_ids, offsets, track_lengths)
         self.cells = cells
 
+    @classmethod
+    def from_ragged(cls, cell_ids, offsets, cells=None, hit_ids=None):
+        """
+        Creates the tracks from the ragged arrays (cell_ids, offsets), without copying them
+        if the tracks are grouped by decreasing length (as generated).
+
+        - cells: array of the cells (pairs of hit ids) the cell_ids refer to, only needed
+        for the hit ids of the tracks if hit_ids isn't given
+        - hit_ids: flat array of the hit ids of the tracks (see to_hits with sort_hits=False)
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        lengths = np.diff(offsets)
+
+        if not np.all(lengths[1:] <= lengths[:-1]):
+            order = np.argsort(-lengths, kind="stable")
+            _, indices = expand_ranges(offsets[order], offsets[order + 1])
+
+            cell_ids = np.asarray(cell_ids)[indices]
+            if hit_ids is not None:
+                hit_starts = offsets + np.arange(offsets.shape[0])
+                _, hit_indices = expand_ranges(
+                    hit_starts[order], hit_starts[order + 1]
+                )
+                hit_ids = np.asarray(hit_ids)[hit_indices]
+
+            lengths = lengths[order]
+            offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+        tracks = cls.__new__(cls)
+        tracks.set_ragged(cell_ids, offsets, np.unique(lengths)[::-1].tolist())
+        tracks.cells = cells
+
+        if hit_ids is not None:
+            tracks._hit_ids = hit_ids
+
+        return tracks
+
+    def set_ragged(self, cell_ids, offsets, track_lengths):
+        """
+        Sets the ragged arrays and the dictionary of views (of each track length, in that order)
+        """
+        self.clear()
+
+        self.cell_ids = cell_ids
+        self.offsets = offsets
+
+        lengths = np.diff(offsets)
+        for track_length in track_lengths:
+            first, last = np.searchsorted(-lengths, [-track_length, -track_length + 1])
+            tracks = cell_ids[offsets[first] : offsets[last]]
+            self[track_length] = tracks.reshape(last - first, track_length)
+
     @property
     def size(self):
         """
-        Gives the total number of tracks 
+        Gives the total number of tracks
+        """
+        return self.offsets.shape[0] - 1
+
+    @property
+    def hit_offsets(self):
+        """
+        The hits of track i are hit_ids[hit_offsets[i] : hit_offsets[i + 1]]
+        (tracks as hits are 1 longer than tracks as cells)
+        """
+        return self.offsets + np.arange(self.offsets.shape[0])
+
+    @property
+    def hit_ids(self):
+        """
+        Flat array of the hit ids of the tracks, from the outermost hit
+        """
+        if not hasattr(self, "_hit_ids"):
+            hit_ids = np.empty(self.cell_ids.shape[0] + self.size, dtype=np.int32)
+
+            # Outer hit of each cell, then the inner hit of the last cell of each track
+            track_of_cells = np.repeat(np.arange(self.size), np.diff(self.offsets))
+            hit_ids[np.arange(self.cell_ids.shape[0]) + track_of_cells] = self.cells[
+                self.cell_ids, 1
+            ]
+            hit_ids[self.hit_offsets[1:] - 1] = self.cells[
+                self.cell_ids[self.offsets[1:] - 1], 0
+            ]
+
+            self._hit_ids = hit_ids
+
+        return self._hit_ids
+
+    @property
+    def sorted_hit_ids(self):
+        """
+        Flat array of the hit ids of the tracks, sorted within each track
+        """
+        if not hasattr(self, "_sorted_hit_ids"):
+            hits_per_length = self.views(self.hit_ids).values()
+            self._sorted_hit_ids = np.concatenate(
+                [np.sort(tracks, axis=1).reshape(-1) for tracks in hits_per_length]
+                + [np.empty(0, dtype=self.hit_ids.dtype)]
+            )
+
+        return self._sorted_hit_ids
+
+    def views(self, hit_ids):
         """
-        return reduce(lambda tot, arr: tot + arr.shape[0], self.values(), 0)
+        Dictionary of views of the flat hit_ids, of shape {[track length]: array (track, hit)}
+        (only the non-empty track lengths)
+        """
+        hit_offsets = self.hit_offsets
+        lengths = np.diff(self.offsets)
+
+        views = {}
+        for track_length, tracks in self.items():
+            if len(tracks) < 1:
+                continue
+
+            first = np.searchsorted(-lengths, -track_length)
+            start = hit_offsets[first]
+            stop = start + tracks.shape[0] * (track_length + 1)
+
+            views[track_length + 1] = hit_ids[start:stop].reshape(-1, track_length + 1)
+
+        return views
 
     def to_hits(self, sort_hits=True):
         """
@@ -30,41 +168,126 @@ class Tracks(dict):
         {
             [track length]: Numpy array of hit_ids
         }
+        whose values are views of hit_ids (or sorted_hit_ids if sort_hits)
         """
-        attr_name = "_sorted_hits" if sort_hits else "_hits"
+        return self.views(self.sorted_hit_ids if sort_hits else self.hit_ids)
 
-        if hasattr(self, attr_name):
-            return getattr(self, attr_name)
+    def to_particles(self):
+        pass
 
-        tracks_as_hits = {}
 
-        for track_length, tracks in self.items():
-            # tracks as hits are 1 longer than tracks as cells
-            new_track_length = track_length + 1
+def save_tracks(path, tracks_by_event):
+    """
+    Saves the tracks of many events at once, as ragged arrays.
 
-            if len(tracks) < 1:
-                continue
+    - path: ".parquet" file (one row per track, needs pyarrow, events without tracks
+    are then left out), ".npz" file, or else a directory of .npy files which load_tracks
+    memory-maps
+    - tracks_by_event: dict of shape {[event_id]: Tracks}
+    """
+    event_ids = list(tracks_by_event.keys())
+    all_tracks = [tracks_by_event[event_id] for event_id in event_ids]
+
+    sizes = np.array([tracks.size for tracks in all_tracks], dtype=np.int64)
+    lengths = np.concatenate(
+        [np.diff(tracks.offsets) for tracks in all_tracks]
+        + [np.empty(0, dtype=np.int64)]
+    )
 
-            most_hits = self.cells[tracks][:, :, 1]
-            last_hit = self.cells[tracks][:, -1, 0]
+    arrays = {
+        "event_ids": np.array(event_ids),
+        "event_offsets": np.concatenate(([0], np.cumsum(sizes))),
+        "offsets": np.concatenate(([0], np.cumsum(lengths))),
+        "cell_ids": np.concatenate(
+            [tracks.cell_ids for tracks in all_tracks] + [np.empty(0, dtype=np.int32)]
+        ).astype(np.int32),
+        "hit_ids": np.concatenate(
+            [tracks.hit_ids for tracks in all_tracks] + [np.empty(0, dtype=np.int32)]
+        ).astype(np.int32),
+    }
 
-            track_as_hits = np.hstack((most_hits, last_hit[..., np.newaxis]))
+    if path.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
 
-            tracks_as_hits[new_track_length] = (
-                np.sort(track_as_hits) if sort_hits else track_as_hits
-            )
+        table = pa.table(
+            {
+                "event_id": np.repeat(arrays["event_ids"], sizes),
+                "cell_ids": pa.LargeListArray.from_arrays(
+                    arrays["offsets"], arrays["cell_ids"]
+                ),
+                "hit_ids": pa.LargeListArray.from_arrays(
+                    arrays["offsets"] + np.arange(lengths.shape[0] + 1),
+                    arrays["hit_ids"],
+                ),
+            }
+        )
+        pq.write_table(table, path)
 
-        setattr(self, attr_name, tracks_as_hits)
+    elif path.endswith(".npz"):
+        np.savez(path, **arrays)
 
-        return getattr(self, attr_name)
+    else:
+        os.makedirs(path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), array)
 
-    def to_particles(self):
-        pass
 
+def load_tracks(path, mmap_mode="r"):
+    """
+    Loads the tracks saved by save_tracks.
+
+    The Tracks returned don't have cells, their hit ids being loaded too. Their arrays are
+    views of the loaded arrays, memory-mapped (with mmap_mode) for a directory of .npy files
+    and with pyarrow for a .parquet file: only the tracks accessed are then read from disk.
+
+    returns a dict of shape {[event_id]: Tracks}
+    """
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path, memory_map=True)
+        cell_lists = table.column("cell_ids").combine_chunks()
+        hit_lists = table.column("hit_ids").combine_chunks()
+
+        event_column = table.column("event_id").to_numpy()
+        event_ids, event_starts = np.unique(event_column, return_index=True)
+        event_ids = event_ids[np.argsort(event_starts)]
+
+        offsets = cell_lists.offsets.to_numpy()
+        arrays = {
+            "event_ids": event_ids,
+            "event_offsets": np.append(np.sort(event_starts), event_column.shape[0]),
+            "offsets": offsets - offsets[0],
+            "cell_ids": cell_lists.flatten().to_numpy(),
+            "hit_ids": hit_lists.flatten().to_numpy(),
+        }
+
+    elif path.endswith(".npz"):
+        arrays = np.load(path)
+
+    else:
+        arrays = {
+            name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+            for name in ["event_ids", "event_offsets", "offsets", "cell_ids", "hit_ids"]
+        }
+
+    event_offsets = np.asarray(arrays["event_offsets"])
+    offsets = np.asarray(arrays["offsets"])
+    cell_ids, hit_ids = arrays["cell_ids"], arrays["hit_ids"]
+
+    tracks_by_event = {}
+    for i, event_id in enumerate(np.asarray(arrays["event_ids"]).tolist()):
+        first, last = event_offsets[i], event_offsets[i + 1]
+        track_offsets = offsets[first : last + 1]
+
+        # The hits of a track are 1 more than its cells
+        hit_start, hit_stop = track_offsets[[0, -1]] + [first, last]
+
+        tracks_by_event[event_id] = Tracks.from_ragged(
+            cell_ids[track_offsets[0] : track_offsets[-1]],
+            track_offsets - track_offsets[0],
+            hit_ids=hit_ids[hit_start:hit_stop],
+        )
 
-# def hits_to_particles(tracks_as_hits, map_hit_to_particle):
-#     return {
-#         track_length: np.array([
-#             [map_hit_to_particle[hit_id] for hit_id in track] for track in tracks
-#         ]) for track_length, tracks in tracks_as_hits.items()
-#     }
+    return tracks_by_event
@@ -1,6 +1,6 @@
 import pandas as pd
 import numpy as np
-from CCA.data.custom_tools import ignore_warning
+from CCA.data.custom_tools import expand_ranges, ignore_warning
 
 
 class Truth(pd.DataFrame):
@@ -9,7 +9,9 @@ class Truth(pd.DataFrame):
     with all pandas.DataFrame properties and additionally:
     - hit_ids
     - particle_ids
-    - to_dict()
+    - particles_of()
+    - tracks
+    - to_track_dict()
     """
 
     def __init__(self, *args, **kwargs):
@@ -41,6 +43,93 @@ class Truth(pd.DataFrame):
 
         return self._pids
 
+    def particles_of(self, hit_ids):
+        """
+        Returns the particle ids of the given hit ids (any shape), -1 for hits not in the truth.
+
+        Uses an index computed once (see hit_particle_index)
+        """
+        lookup, sorted_hit_ids, sorted_particle_ids = self.hit_particle_index
+        hit_ids = np.asarray(hit_ids)
+
+        if lookup is not None:
+            is_in = (hit_ids >= 0) & (hit_ids < lookup.shape[0])
+            return np.where(is_in, lookup[np.where(is_in, hit_ids, 0)], -1)
+
+        positions = np.searchsorted(sorted_hit_ids, hit_ids)
+        positions[positions == sorted_hit_ids.shape[0]] = 0
+        is_in = sorted_hit_ids[positions] == hit_ids
+
+        return np.where(is_in, sorted_particle_ids[positions], -1)
+
+    @property
+    @ignore_warning(UserWarning)
+    def hit_particle_index(self):
+        """
+        Index mapping hit ids to particle ids, of shape (lookup, sorted_hit_ids, sorted_particle_ids):
+        - if hit ids are small non-negative integers (at most a few times as many as the hits),
+        lookup is a dense table such that lookup[hit_id] = particle_id (-1 for unknown hit ids)
+        - otherwise, lookup is None and particle ids are found with a binary search in the
+        sorted hit ids
+        """
+        if not hasattr(self, "_hpindex"):
+            hit_ids = self.hit_ids
+            particle_ids = self.particle_ids
+
+            order = np.argsort(hit_ids, kind="stable")
+            sorted_hit_ids, sorted_particle_ids = hit_ids[order], particle_ids[order]
+
+            lookup = None
+            is_dense = hit_ids.shape[0] > 0 and (
+                sorted_hit_ids[0] >= 0
+                and sorted_hit_ids[-1] < 4 * hit_ids.shape[0] + 1024
+            )
+            if is_dense:
+                lookup = np.full(sorted_hit_ids[-1] + 1, -1, dtype=particle_ids.dtype)
+                lookup[hit_ids] = particle_ids
+
+            self._hpindex = (lookup, sorted_hit_ids, sorted_particle_ids)
+
+        return self._hpindex
+
+    @property
+    @ignore_warning(UserWarning)
+    def tracks(self):
+        """
+        The true tracks as a ragged array (computed once), of shape
+        (hit_ids, offsets, particle_ids) where:
+        - hit_ids: flat array of the *sorted* hit_ids of each track, one track after the other
+        - offsets: the hits of track i are hit_ids[offsets[i] : offsets[i + 1]]
+        - particle_ids: the particle id of each track
+
+        Tracks are grouped by increasing length, and by increasing particle id within a length.
+        """
+        if not hasattr(self, "_tracks"):
+            hit_ids = self.hit_ids
+            particle_ids = self.particle_ids
+
+            # Hits sorted by particle, then by hit_id
+            order = np.lexsort((hit_ids, particle_ids))
+            unique_particle_ids, counts = np.unique(
+                particle_ids[order], return_counts=True
+            )
+            starts = np.cumsum(counts) - counts
+
+            # Tracks reordered by length
+            by_length = np.argsort(counts, kind="stable")
+            _, indices = expand_ranges(
+                starts[by_length], starts[by_length] + counts[by_length]
+            )
+
+            self._tracks = (
+                hit_ids[order][indices],
+                np.concatenate(([0], np.cumsum(counts[by_length]))),
+                unique_particle_ids[by_length],
+            )
+
+        return self._tracks
+
+    @ignore_warning(UserWarning)
     def to_track_dict(self):
         """
         Returns a dictionary of shape
@@ -48,30 +137,26 @@ class Truth(pd.DataFrame):
                 track_length: Array of tracks 
             }
 
-        each track is an array of *sorted* hit_ids
+        each track is an array of *sorted* hit_ids. The arrays are views of the ragged
+        hit_ids of self.tracks.
         """
         if hasattr(self, "_dict"):
             return self._dict
 
-        particle_ids = self.particle_ids
-        unique_particle_ids = np.unique(self.particle_ids)
-        hits_ids = self.hit_ids
+        hit_ids, offsets, _ = self.tracks
+        lengths = np.diff(offsets)
 
-        true_tracks_dict = {}
+        track_lengths, firsts, n_tracks = np.unique(
+            lengths, return_index=True, return_counts=True
+        )
 
-        for particle_id in unique_particle_ids:
-            indices = np.argwhere(particle_ids == particle_id)[:, 0]
-            track = np.sort(hits_ids[indices])
-            track_length = len(track)
+        true_tracks_dict = {}
 
-            if track_length in true_tracks_dict:
-                true_tracks_dict[track_length] = np.vstack(
-                    (true_tracks_dict[track_length], track)
-                )
-            else:
-                true_tracks_dict[track_length] = np.array([track])
+        for track_length, first, n in zip(track_lengths, firsts, n_tracks):
+            true_tracks_dict[track_length] = hit_ids[
+                offsets[first] : offsets[first + n]
+            ].reshape(n, track_length)
 
         self._dict = true_tracks_dict
 
         return self._dict
-
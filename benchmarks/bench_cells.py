@@ -0,0 +1,53 @@
+"""
+Scaling of CellsProcessor.form with the number of hits, for the brute-force
+("mesh") and binned pair searches.
+
+Run from the root of the repository with:
+    python -m benchmarks.bench_cells
+"""
+import time
+
+import numpy as np
+
+from CCA import CellsProcessor, DataProcessor, Event
+from benchmarks.event_generator import generate_event
+
+
+def time_form(hits, min_angle, pair_search):
+    cellsProcessor = CellsProcessor(hits, min_angle, pair_search)
+
+    start = time.perf_counter()
+    cellsProcessor.form(final_print=False)
+
+    return cellsProcessor.cells, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    min_angle = 0.4
+    # The mesh search needs (hits per layer)^2 memory, so it is skipped on large events
+    max_mesh_hits = 20000
+
+    row = "{0:>8} {1:>10} {2:>10} {3:>11}"
+    print(row.format("hits", "cells", "mesh (s)", "binned (s)"))
+
+    for n_particles in [250, 500, 1000, 2000, 4000, 8000]:
+        event = Event("event", path_to_base="")
+        event.data = generate_event(n_particles)
+        hits, truth = DataProcessor(path_to_base="").process_event(event)
+
+        cells, binned_seconds = time_form(hits, min_angle, "binned")
+
+        mesh_seconds = "-"
+        if hits.shape[0] <= max_mesh_hits:
+            mesh_cells, seconds = time_form(hits, min_angle, "mesh")
+            assert np.array_equal(cells, mesh_cells)
+            mesh_seconds = "{0:.3f}".format(seconds)
+
+        print(
+            row.format(
+                hits.shape[0],
+                cells.shape[0],
+                mesh_seconds,
+                "{0:.3f}".format(binned_seconds),
+            )
+        )
@@ -0,0 +1,98 @@
+"""
+Loading time, bytes read from disk, peak memory and resident size of events, for
+.csv files vs. the binary cache and for all content vs. the columns manifest.
+
+Run from the root of the repository with:
+    python -m benchmarks.bench_loading
+"""
+import os
+import tempfile
+import time
+import tracemalloc
+
+from CCA import DataProcessor
+from benchmarks.event_generator import write_event
+
+
+def bytes_on_disk(dp, event_ids):
+    """
+    Size of the files (or cached columns) that the loaded events were read from
+    """
+    n_bytes = 0
+
+    for event_id in event_ids:
+        event = dp.raw_data[event_id]
+
+        for content_name, df in event.data.items():
+            if df is None:
+                continue
+
+            if event.is_cached(content_name):
+                path = event.get_path_to_cache(content_name)
+                n_bytes += sum(
+                    os.path.getsize(path + "/" + column + ".npy")
+                    for column in df.columns
+                )
+            else:
+                n_bytes += os.path.getsize(event.get_path_to(content_name))
+
+    return n_bytes
+
+
+def time_load(dp, event_ids, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    dp.load(event_ids, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    resident_bytes = sum(
+        df.memory_usage(index=False).sum()
+        for event in dp.raw_data.values()
+        for df in event.data.values()
+        if df is not None
+    )
+
+    return seconds, bytes_on_disk(dp, event_ids), peak_bytes, resident_bytes
+
+
+if __name__ == "__main__":
+    n_events = 10
+
+    row = "{0:>16} {1:>10} {2:>10} {3:>10} {4:>10}"
+    results = []
+
+    with tempfile.TemporaryDirectory() as path_to_base:
+        event_ids = ["event{0:09d}".format(i) for i in range(n_events)]
+        for i, event_id in enumerate(event_ids):
+            write_event(path_to_base, event_id, 5000, seed=i)
+
+        for label, kwargs in [
+            ("csv, all", dict(content_to_load="all", all_columns=True)),
+            ("csv, manifest", dict()),
+        ]:
+            dp = DataProcessor(path_to_base)
+            results.append((label,) + time_load(dp, event_ids, **kwargs))
+
+        DataProcessor(path_to_base).build_cache(event_ids)
+
+        for label, kwargs in [
+            ("cache, all", dict(content_to_load="all", all_columns=True)),
+            ("cache, manifest", dict()),
+        ]:
+            dp = DataProcessor(path_to_base)
+            results.append((label,) + time_load(dp, event_ids, **kwargs))
+
+    print("{0} events".format(n_events))
+    print(row.format("", "load (s)", "read (MB)", "peak (MB)", "size (MB)"))
+    for label, seconds, read_bytes, peak_bytes, resident_bytes in results:
+        print(
+            row.format(
+                label,
+                "{0:.4f}".format(seconds),
+                "{0:.1f}".format(read_bytes / 1e6),
+                "{0:.1f}".format(peak_bytes / 1e6),
+                "{0:.1f}".format(resident_bytes / 1e6),
+            )
+        )
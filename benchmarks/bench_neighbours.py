@@ -0,0 +1,64 @@
+"""
+Scaling of the cell matching of NeighboursProcessor.find_neighbours with the number
+of cells, for the brute-force ("mesh") and join matchings.
+
+Run from the root of the repository with:
+    python -m benchmarks.bench_neighbours
+"""
+import time
+
+from CCA import CellsProcessor, DataProcessor, Event, NeighboursProcessor
+from benchmarks.event_generator import generate_event
+
+
+def time_find_neighbours(cellsProcessor, max_angle, matching):
+    neighboursProcessor = NeighboursProcessor(
+        cellsProcessor, max_angle, matching=matching
+    )
+
+    start = time.perf_counter()
+    neighboursProcessor.find_neighbours(final_print=False)
+    seconds = time.perf_counter() - start
+
+    neighs = {
+        cell: cell_info["inner_neighs"].tolist()
+        for cell, cell_info in neighboursProcessor.CA.items()
+    }
+
+    return neighs, seconds
+
+
+if __name__ == "__main__":
+    cell_angle = 0.4
+    neigh_angle = 0.15
+    # The mesh matching needs (cells per layer)^2 memory, so it is skipped on large events
+    max_mesh_cells = 100000
+
+    row = "{0:>10} {1:>12} {2:>10} {3:>10}"
+    print(row.format("cells", "neighbours", "mesh (s)", "join (s)"))
+
+    for n_particles in [250, 500, 1000, 2000, 4000]:
+        event = Event("event", path_to_base="")
+        event.data = generate_event(n_particles)
+        hits, truth = DataProcessor(path_to_base="").process_event(event)
+
+        cellsProcessor = CellsProcessor(hits, cell_angle)
+        cellsProcessor.form(final_print=False)
+        n_cells = cellsProcessor.cells.shape[0]
+
+        neighs, join_seconds = time_find_neighbours(cellsProcessor, neigh_angle, "join")
+
+        mesh_seconds = "-"
+        if n_cells <= max_mesh_cells:
+            mesh_neighs, seconds = time_find_neighbours(
+                cellsProcessor, neigh_angle, "mesh"
+            )
+            assert mesh_neighs == neighs
+            mesh_seconds = "{0:.3f}".format(seconds)
+
+        n_neighs = sum(len(inner_neighs) for inner_neighs in neighs.values())
+        print(
+            row.format(
+                n_cells, n_neighs, mesh_seconds, "{0:.3f}".format(join_seconds)
+            )
+        )
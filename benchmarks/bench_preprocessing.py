@@ -0,0 +1,36 @@
+"""
+Scaling of DataProcessor.process with the number of hits in the event.
+
+Run from the root of the repository with:
+    python -m benchmarks.bench_preprocessing
+"""
+import time
+
+from CCA import DataProcessor, Event
+from benchmarks.event_generator import generate_event
+
+
+def time_process(n_particles, repeats=3):
+    event_id = "event{0:09d}".format(n_particles)
+
+    event = Event(event_id, path_to_base="")
+    event.data = generate_event(n_particles)
+
+    dp = DataProcessor(path_to_base="")
+    dp.raw_data[event_id] = event
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        hits, truth = dp.process(event_id, pT_min=0.5)
+        timings.append(time.perf_counter() - start)
+
+    return event.data["hits"].shape[0], hits.shape[0], min(timings)
+
+
+if __name__ == "__main__":
+    print("{0:>10} {1:>10} {2:>12}".format("raw hits", "kept hits", "process (s)"))
+
+    for n_particles in [1000, 2000, 5000, 10000, 20000]:
+        n_hits, n_kept, seconds = time_process(n_particles)
+        print("{0:>10} {1:>10} {2:>12.4f}".format(n_hits, n_kept, seconds))
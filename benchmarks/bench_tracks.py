@@ -0,0 +1,66 @@
+"""
+Scaling of TracksProcessor.generate with the number of particles, with and
+without a cap on the number of candidates per seed cell.
+
+Run from the root of the repository with:
+    python -m benchmarks.bench_tracks
+"""
+import time
+
+from CCA import (
+    CellsProcessor,
+    DataProcessor,
+    Event,
+    EvolutionProcessor,
+    NeighboursProcessor,
+    TracksProcessor,
+)
+from benchmarks.event_generator import generate_event
+
+
+def time_generate(evolutionProcessor, min_length, max_paths_per_seed):
+    tracksProcessor = TracksProcessor(evolutionProcessor, min_length)
+
+    start = time.perf_counter()
+    tracksProcessor.generate(final_print=False, max_paths_per_seed=max_paths_per_seed)
+
+    return tracksProcessor.tracks.size, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    cell_angle = 0.4
+    neigh_angle = 0.15
+    min_length = 3
+    max_paths_per_seed = 8
+
+    row = "{0:>10} {1:>10} {2:>10} {3:>10} {4:>10}"
+    print(row.format("cells", "tracks", "all (s)", "capped", "capped (s)"))
+
+    for n_particles in [250, 500, 1000]:
+        event = Event("event", path_to_base="")
+        event.data = generate_event(n_particles)
+        hits, truth = DataProcessor(path_to_base="").process_event(event)
+
+        cellsProcessor = CellsProcessor(hits, cell_angle)
+        cellsProcessor.form(final_print=False)
+
+        neighboursProcessor = NeighboursProcessor(cellsProcessor, neigh_angle)
+        neighboursProcessor.find_neighbours(final_print=False)
+
+        evolutionProcessor = EvolutionProcessor(neighboursProcessor)
+        evolutionProcessor.evolve(final_print=False)
+
+        n_tracks, seconds = time_generate(evolutionProcessor, min_length, None)
+        n_capped, capped_seconds = time_generate(
+            evolutionProcessor, min_length, max_paths_per_seed
+        )
+
+        print(
+            row.format(
+                cellsProcessor.cells.shape[0],
+                n_tracks,
+                "{0:.3f}".format(seconds),
+                n_capped,
+                "{0:.3f}".format(capped_seconds),
+            )
+        )
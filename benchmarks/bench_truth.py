@@ -0,0 +1,67 @@
+"""
+Time of Truth.to_track_dict on full events, against the per-particle loop it replaced.
+
+Run from the root of the repository with:
+    python -m benchmarks.bench_truth
+"""
+import time
+
+import numpy as np
+
+from CCA import DataProcessor, Event
+from benchmarks.event_generator import generate_event
+
+
+def loop_track_dict(truth):
+    """
+    Former implementation: one scan of the particle ids per particle
+    """
+    particle_ids = truth.particle_ids
+    hits_ids = truth.hit_ids
+
+    true_tracks_dict = {}
+
+    for particle_id in np.unique(particle_ids):
+        indices = np.argwhere(particle_ids == particle_id)[:, 0]
+        track = np.sort(hits_ids[indices])
+        track_length = len(track)
+
+        if track_length in true_tracks_dict:
+            true_tracks_dict[track_length] = np.vstack(
+                (true_tracks_dict[track_length], track)
+            )
+        else:
+            true_tracks_dict[track_length] = np.array([track])
+
+    return true_tracks_dict
+
+
+if __name__ == "__main__":
+    row = "{0:>10} {1:>10} {2:>10} {3:>12}"
+    print(row.format("particles", "hits", "loop (s)", "sort (s)"))
+
+    for n_particles in [1000, 5000, 10000]:
+        event = Event("event", path_to_base="")
+        event.data = generate_event(n_particles)
+        hits, truth = DataProcessor(path_to_base="").process_event(event)
+
+        start = time.perf_counter()
+        loop_dict = loop_track_dict(truth)
+        loop_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        track_dict = truth.to_track_dict()
+        sort_seconds = time.perf_counter() - start
+
+        assert loop_dict.keys() == track_dict.keys()
+        for track_length, tracks in loop_dict.items():
+            assert np.array_equal(tracks, track_dict[track_length])
+
+        print(
+            row.format(
+                n_particles,
+                truth.shape[0],
+                "{0:.3f}".format(loop_seconds),
+                "{0:.4f}".format(sort_seconds),
+            )
+        )
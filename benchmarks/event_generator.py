@@ -0,0 +1,162 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Approximate radii (mm) of the barrel layers of volumes 8, 13 and 17 of the TrackML detector
+BARREL_LAYERS = {
+    8: {2: 32.0, 4: 72.0, 6: 116.0, 8: 172.0},
+    13: {2: 260.0, 4: 360.0, 6: 500.0, 8: 660.0},
+    17: {2: 820.0, 4: 1020.0},
+}
+
+# Half-length (mm) of each barrel volume along z
+BARREL_HALF_LENGTH = {8: 490.0, 13: 1080.0, 17: 1080.0}
+
+
+def generate_event(n_particles, duplicate_fraction=0.05, noise_fraction=0.1, seed=0):
+    """
+    Generates a synthetic TrackML-like event of helical tracks crossing the barrel volumes.
+
+    returns a dict of shape
+    {
+        "hits": DataFrame(hit_id, x, y, z, volume_id, layer_id),
+        "particles": DataFrame(particle_id, vx, vy, vz, px, py, pz, q, nhits),
+        "truth": DataFrame(hit_id, particle_id, tx, ty, tz, tpx, tpy, tpz, weight),
+        "cells": DataFrame(hit_id, ch0, ch1, value),
+    }
+
+    - duplicate_fraction: probability for a hit to get a second hit on the same layer
+    - noise_fraction: number of noise hits (particle_id = 0) relative to the number of true hits
+    """
+    rng = np.random.default_rng(seed)
+
+    particle_ids = np.arange(1, n_particles + 1, dtype=np.int64) << 32
+    pT = 0.2 + rng.exponential(1.0, n_particles)
+    phi0 = rng.uniform(-np.pi, np.pi, n_particles)
+    eta = rng.uniform(-1.0, 1.0, n_particles)
+    charge = rng.choice([-1, 1], n_particles)
+    vz = rng.normal(0.0, 5.0, n_particles)
+
+    # Radius of curvature (mm) in a 2T field
+    R = pT / 0.6 * 1000.0
+
+    hits = []
+    for volume_id, layers in BARREL_LAYERS.items():
+        for layer_id, r in layers.items():
+            reachable = r < 2 * R
+            dphi = np.arcsin(np.minimum(r / (2 * R), 1.0)) * charge
+            z = vz + r * np.sinh(eta)
+            inside = reachable & (np.abs(z) < BARREL_HALF_LENGTH[volume_id])
+
+            phi = phi0 + dphi
+            n = np.count_nonzero(inside)
+            hits.append(
+                pd.DataFrame(
+                    {
+                        "x": r * np.cos(phi[inside]),
+                        "y": r * np.sin(phi[inside]),
+                        "z": z[inside],
+                        "volume_id": volume_id,
+                        "layer_id": layer_id,
+                        "particle_id": particle_ids[inside],
+                    }
+                )
+            )
+
+            # Duplicate hits from the same particle on the same layer (module overlaps)
+            dup = rng.random(n) < duplicate_fraction
+            if np.any(dup):
+                dup_hits = hits[-1][dup].copy()
+                dup_phi = np.arctan2(dup_hits["y"], dup_hits["x"]) + 0.002
+                dup_hits["x"] = r * np.cos(dup_phi)
+                dup_hits["y"] = r * np.sin(dup_phi)
+                hits.append(dup_hits)
+
+    df = pd.concat(hits, ignore_index=True)
+
+    # Noise hits
+    n_noise = int(noise_fraction * df.shape[0])
+    volume_layers = [
+        (v, l, r) for v, ls in BARREL_LAYERS.items() for l, r in ls.items()
+    ]
+    picks = rng.integers(0, len(volume_layers), n_noise)
+    noise_r = np.array([volume_layers[p][2] for p in picks])
+    noise_phi = rng.uniform(-np.pi, np.pi, n_noise)
+    noise = pd.DataFrame(
+        {
+            "x": noise_r * np.cos(noise_phi),
+            "y": noise_r * np.sin(noise_phi),
+            "z": rng.uniform(-400, 400, n_noise),
+            "volume_id": [volume_layers[p][0] for p in picks],
+            "layer_id": [volume_layers[p][1] for p in picks],
+            "particle_id": 0,
+        }
+    )
+    df = pd.concat([df, noise], ignore_index=True)
+
+    # Like in the dataset, hits are ordered by detector layer, but shuffled within a layer
+    df = df.iloc[rng.permutation(df.shape[0])]
+    df = df.sort_values(["volume_id", "layer_id"], kind="stable").reset_index(drop=True)
+    df.insert(0, "hit_id", np.arange(1, df.shape[0] + 1))
+
+    df_hits = df[["hit_id", "x", "y", "z", "volume_id", "layer_id"]].copy()
+    df_hits["module_id"] = 1
+
+    df_truth = pd.DataFrame(
+        {
+            "hit_id": df["hit_id"],
+            "particle_id": df["particle_id"],
+            "tx": df["x"],
+            "ty": df["y"],
+            "tz": df["z"],
+            "tpx": 0.0,
+            "tpy": 0.0,
+            "tpz": 0.0,
+            "weight": 0.0,
+        }
+    )
+
+    nhits = df["particle_id"].value_counts()
+    df_particles = pd.DataFrame(
+        {
+            "particle_id": particle_ids,
+            "vx": 0.0,
+            "vy": 0.0,
+            "vz": vz,
+            "px": pT * np.cos(phi0),
+            "py": pT * np.sin(phi0),
+            "pz": pT * np.sinh(eta),
+            "q": charge,
+            "nhits": nhits.reindex(particle_ids, fill_value=0).to_numpy(),
+        }
+    )
+
+    n_cells = 4
+    df_cells = pd.DataFrame(
+        {
+            "hit_id": np.repeat(df["hit_id"].to_numpy(), n_cells),
+            "ch0": rng.integers(0, 1000, n_cells * df.shape[0]),
+            "ch1": rng.integers(0, 1000, n_cells * df.shape[0]),
+            "value": rng.random(n_cells * df.shape[0]),
+        }
+    )
+
+    return {
+        "hits": df_hits,
+        "particles": df_particles,
+        "truth": df_truth,
+        "cells": df_cells,
+    }
+
+
+def write_event(path_to_base, event_id, n_particles, **kwargs):
+    """
+    Generates an event and writes it in the TrackML .csv layout:
+    path_to_base/event_id-{cells,hits,particles,truth}.csv
+    """
+    os.makedirs(path_to_base, exist_ok=True)
+
+    for content_name, df in generate_event(n_particles, **kwargs).items():
+        path = os.path.join(path_to_base, event_id + "-" + content_name + ".csv")
+        df.to_csv(path, index=False)